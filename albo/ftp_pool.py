@@ -0,0 +1,121 @@
+import ftplib
+import threading
+import time
+from contextlib import contextmanager
+
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+from albo.metrics import FTP_CONNECT_SECONDS
+
+logger_celery = get_task_logger(__name__)
+
+
+def connect_ftp(ftp_data):
+    """Open a connection from "host:user:password", an optional fourth field is the port."""
+    host, user, passwd, port = (ftp_data.split(':') + [''] * 3)[:4]
+    ftp = ftplib.FTP()
+    with FTP_CONNECT_SECONDS.time():
+        ftp.connect(host, int(port or 21))
+        if user:
+            ftp.login(user, passwd)
+    return ftp
+
+
+class FTPPool:
+    """Logged in FTP connections of the worker process, reused between task runs.
+
+    Connections are kept per address ("host:user:password"). One that was idle longer than
+    `keepalive` seconds is checked with NOOP before reuse, one idle longer than `max_idle`
+    is assumed dropped by the server and replaced. Directory listings are cached for
+    `listing_ttl` seconds.
+    """
+
+    def __init__(self, keepalive=30, max_idle=240, listing_ttl=20):
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.listing_ttl = listing_ttl
+        self._idle = {}
+        self._listings = {}
+        self._no_mlsd = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, address):
+        ftp = self._acquire(address)
+        try:
+            yield ftp
+        except BaseException:
+            # the control connection may be in the middle of a transfer, never reuse it
+            ftp.close()
+            raise
+        self._release(address, ftp)
+
+    def listing(self, address, ftp):
+        """Return {filename: facts} of the current directory.
+
+        MLSD is used where the server supports it, its facts carry size and modify time
+        of every file; otherwise NLST names are returned with empty facts.
+        """
+        now = time.monotonic()
+        cached = self._listings.get(address)
+        if cached and now - cached[0] < self.listing_ttl:
+            return cached[1]
+
+        dict_files = None
+        if address not in self._no_mlsd:
+            try:
+                dict_files = {name: facts for name, facts in ftp.mlsd() if facts.get('type', 'file') == 'file'}
+            except ftplib.error_perm:
+                self._no_mlsd.add(address)
+        if dict_files is None:
+            dict_files = dict.fromkeys(ftp.nlst(), {})
+
+        self._listings[address] = (now, dict_files)
+        return dict_files
+
+    def invalidate_listing(self, address):
+        self._listings.pop(address, None)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for list_connection in idle.values():
+            for ftp, _ in list_connection:
+                self._close(ftp)
+        self._listings.clear()
+
+    def _acquire(self, address):
+        while True:
+            with self._lock:
+                list_connection = self._idle.get(address)
+                if not list_connection:
+                    break
+                ftp, last_used = list_connection.pop()
+            idle = time.monotonic() - last_used
+            if idle > self.max_idle:
+                self._close(ftp)
+                continue
+            if idle > self.keepalive:
+                try:
+                    ftp.voidcmd('NOOP')
+                except ftplib.all_errors:
+                    logger_celery.debug('reconnect to %s' % address.split(':')[0])
+                    self._close(ftp)
+                    continue
+            return ftp
+        return connect_ftp(address)
+
+    def _release(self, address, ftp):
+        with self._lock:
+            self._idle.setdefault(address, []).append((ftp, time.monotonic()))
+
+    @staticmethod
+    def _close(ftp):
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+
+ftp_pool = FTPPool(settings.FTP_POOL_KEEPALIVE, settings.FTP_POOL_MAX_IDLE, settings.FTP_LISTING_TTL)
@@ -0,0 +1,166 @@
+"""Lease lock shared by the web and worker processes through the default (Redis) cache.
+
+The holder of a lock is identified by a token, so a lock taken by one task can be extended
+and released by the tasks it starts on other workers. A lock whose holder dies without
+releasing it expires after its lease.
+
+On django-redis the check of the token and the action on the lock run in one Lua script, so
+a run whose lease has expired can not extend or delete the lock of the next one. Other cache
+backends (the local memory cache of the tests) only serialize these steps in the process.
+"""
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.core.cache import cache, caches
+from django_redis import get_redis_connection
+from django_redis.cache import RedisCache
+from redis import RedisError
+
+logger = logging.getLogger(__name__)
+
+EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+local pending = redis.call('get', KEYS[2])
+if pending then
+    redis.call('del', KEYS[2])
+end
+return pending
+"""
+REQUEST_PENDING_SCRIPT = """
+local existed = redis.call('exists', KEYS[1])
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return existed
+"""
+
+_local_lock = threading.Lock()
+
+
+def get_redis_client():
+    """Return the client of the default cache when it is django-redis, otherwise None."""
+    if not isinstance(caches['default'], RedisCache):
+        return None
+    return get_redis_connection('default')
+
+
+class CacheLock:
+    def __init__(self, name, lease, pending_timeout=60 * 60):
+        self.key = f'lock:{name}'
+        self.pending_key = f'lock-pending:{name}'
+        self.lease = lease
+        # a requested run not started in this time is dropped, the next trigger asks again
+        self.pending_timeout = pending_timeout
+
+    def acquire(self):
+        """Return the token of the taken lock, or None when another run holds it."""
+        token = uuid4().hex
+        client = get_redis_client()
+        if client is None:
+            added = cache.add(self.key, token, self.lease)
+        else:
+            try:
+                added = bool(client.set(cache.make_key(self.key), token, nx=True, px=int(self.lease * 1000)))
+            except RedisError:
+                added = None
+        if added is None:
+            # redis is unreachable, run unlocked as without the lock
+            logger.warning('cache unavailable, %s runs without the lock', self.key)
+            return token
+        return token if added else None
+
+    def is_held(self, token):
+        if token is None:
+            return False
+        client = get_redis_client()
+        if client is None:
+            return cache.get(self.key) == token
+        try:
+            return client.get(cache.make_key(self.key)) == token.encode()
+        except RedisError:
+            return False
+
+    def extend(self, token):
+        if token is None:
+            return False
+        client = get_redis_client()
+        if client is None:
+            with _local_lock:
+                if cache.get(self.key) != token:
+                    return False
+                cache.touch(self.key, self.lease)
+                return True
+        try:
+            return bool(client.eval(EXTEND_SCRIPT, 1, cache.make_key(self.key), token, int(self.lease * 1000)))
+        except RedisError:
+            logger.warning('cache unavailable, %s is not extended', self.key)
+            return False
+
+    def release(self, token):
+        """Release the lock and return the arguments of the run requested while it was held."""
+        client = get_redis_client()
+        if client is None:
+            with _local_lock:
+                if token is not None and cache.get(self.key) == token:
+                    cache.delete(self.key)
+                pending = cache.get(self.pending_key)
+                if pending is not None:
+                    cache.delete(self.pending_key)
+                return pending
+        try:
+            pending = client.eval(RELEASE_SCRIPT, 2, cache.make_key(self.key), cache.make_key(self.pending_key),
+                                  token or '')
+        except RedisError:
+            logger.warning('cache unavailable, %s is left to expire', self.key)
+            return None
+        return json.loads(pending) if pending is not None else None
+
+    def request_pending(self, arguments):
+        """Ask for one run after the current one; return False when one is already requested."""
+        # requests arriving during a run fold into one, with the arguments of the latest
+        client = get_redis_client()
+        if client is None:
+            with _local_lock:
+                if cache.add(self.pending_key, arguments, self.pending_timeout):
+                    return True
+                cache.set(self.pending_key, arguments, self.pending_timeout)
+                return False
+        try:
+            existed = client.eval(REQUEST_PENDING_SCRIPT, 1, cache.make_key(self.pending_key), json.dumps(arguments),
+                                  int(self.pending_timeout))
+        except RedisError:
+            logger.warning('cache unavailable, the run requested after %s is dropped', self.key)
+            return True
+        return not existed
+
+    @contextmanager
+    def heartbeat(self, token):
+        """Extend the lease every third of it while the block runs."""
+        if token is None:
+            yield
+            return
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.lease / 3):
+                if not self.extend(token):
+                    logger.warning('%s is lost, its lease expired', self.key)
+                    return
+
+        self.extend(token)
+        thread = threading.Thread(target=beat, name=f'heartbeat-{self.key}', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
@@ -0,0 +1,45 @@
+"""Prometheus metrics of the import and export tasks and of the catalog cache.
+
+With PROMETHEUS_MULTIPROC_DIR set every web and worker process writes its samples to that
+directory and `get_registry` merges them, so the /metrics/ view of the web app and the
+HTTP server of a Celery worker report the totals of all their processes.
+"""
+import os
+
+from celery.signals import worker_process_shutdown, worker_ready
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, multiprocess, start_http_server
+
+STAGE_SECONDS = Histogram('albo_import_stage_seconds', 'Seconds spent in a stage of the import', ['stage'],
+                          buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+FTP_CONNECT_SECONDS = Histogram('albo_ftp_connect_seconds', 'Seconds to connect and log in to an FTP server')
+FTP_TRANSFER_BYTES = Counter('albo_ftp_transfer_bytes', 'Bytes moved over FTP data connections', ['direction'])
+CSV_ROWS = Counter('albo_import_csv_rows', 'Rows parsed from import files')
+MAPPING_CODES = Counter('albo_import_mapping_codes', '1C codes of import files by mapping result', ['result'])
+DB_ROWS = Counter('albo_import_db_rows', 'AlboProductModel rows updated by the import')
+IMPORT_RUNS = Counter('albo_import_runs', 'Import runs by result', ['result'])
+IMPORT_LAG_SECONDS = Histogram('albo_import_lag_seconds', 'Seconds from the timestamp of an import file to its write',
+                               buckets=(5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+CATALOG_CACHE_REQUESTS = Counter('albo_catalog_cache_requests', 'Catalog cache lookups by cache and result',
+                                 ['cache', 'result'])
+
+
+def get_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+@worker_ready.connect
+def start_worker_metrics_server(sender=None, **kwargs):
+    from django.conf import settings
+
+    if settings.WORKER_METRICS_PORT:
+        start_http_server(settings.WORKER_METRICS_PORT, registry=get_registry())
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid=None, **kwargs):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
@@ -0,0 +1,79 @@
+"""Parse engines of the 1C import files, chosen by the size of the file.
+
+Every engine reads the first two columns of a ;-delimited file with a header row: the 1C
+code as a string and its quantity. `csv` returns {code: quantity} with the last quantity of
+a repeated code and needs neither pandas nor numpy, `pandas` and `pyarrow` return a
+DataFrame for QuantityAggregator. All of them give the same import result.
+"""
+import csv
+import importlib.util
+import re
+
+from django.conf import settings
+
+PARSE_ENGINES = ('csv', 'pandas', 'pyarrow')
+SPACE_RE = re.compile(r'\s+')
+
+
+def choose_engine(size):
+    """Return the engine for a file of size bytes, IMPORT_PARSE_ENGINE when it is not 'auto'."""
+    engine = settings.IMPORT_PARSE_ENGINE
+    if engine == 'auto':
+        if size < settings.IMPORT_PARSE_CSV_MAX_BYTES:
+            engine = 'csv'
+        elif size >= settings.IMPORT_PARSE_PYARROW_MIN_BYTES:
+            engine = 'pyarrow'
+        else:
+            engine = 'pandas'
+    if engine == 'pyarrow' and importlib.util.find_spec('pyarrow') is None:
+        # optional dependency, the C engine of pandas reads the large files without it
+        engine = 'pandas'
+    return engine
+
+
+def parse_quantity(value):
+    """Quantity of one row like '1 234', the same number clean_quantity gives for the column."""
+    text = SPACE_RE.sub('', value)
+    try:
+        return int(text)
+    except ValueError:
+        return int(float(text))
+
+
+def parse_csv(file):
+    """Return ({code: quantity}, number of rows) read with the csv module."""
+    quantities = {}
+    rows = 0
+    with open(file, newline='', encoding='utf-8') as f_obj:
+        reader = csv.reader(f_obj, delimiter=';')
+        next(reader, None)
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < 2:
+                raise ValueError('row %s of %s has no quantity' % (reader.line_num, file))
+            quantities[row[0]] = parse_quantity(row[1])
+            rows += 1
+    return quantities, rows
+
+
+def parse_pandas(file):
+    import pandas as pd
+
+    return pd.read_csv(file, delimiter=';', dtype={0: str}, usecols=[0, 1], engine='c')
+
+
+def parse_pyarrow(file):
+    """Read the file with the multithreaded reader of pyarrow."""
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    with open(file, newline='', encoding='utf-8') as f_obj:
+        header = next(csv.reader(f_obj, delimiter=';'))
+    code, quantity = header[:2]
+    table = pa_csv.read_csv(
+        file,
+        parse_options=pa_csv.ParseOptions(delimiter=';'),
+        convert_options=pa_csv.ConvertOptions(include_columns=[code, quantity], column_types={code: pa.string()}),
+    )
+    return table.to_pandas()
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 import os
+import sys
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -24,6 +26,9 @@ load_dotenv(dotenv_path='.env_dev')
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv("SECRET_KEY")
+if not SECRET_KEY and sys.argv[1:2] == ['test']:
+    # `manage.py test` runs on a checkout without .env_dev
+    SECRET_KEY = 'django-insecure-test-only'
 # SECURITY WARNING: don't run with debug turned on in production!
 
 DEBUG = os.getenv("DEBUG", True)
@@ -84,6 +89,21 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'redis://127.0.0.1:6379/1'),
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            # a missing redis makes every lookup a miss instead of an error
+            'IGNORE_EXCEPTIONS': True,
+        },
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -129,8 +149,54 @@ CELERY_RESULT_BACKEND = os.environ.get("CELERY_BACKEND", "redis://127.0.0.1:6379
 CELERY_IMPORTS = ("albo.tasks",)
 
 IMPORT_FTP_ADDRESS = os.environ.get('IMPORT_FTP_ADDRESS')
+# several warehouses, comma separated host:user:password entries
+IMPORT_FTP_ADDRESSES = [i for i in os.environ.get('IMPORT_FTP_ADDRESSES', '').split(',') if i] or [IMPORT_FTP_ADDRESS]
 EXPORT_FTP_ADDRESS = os.environ.get('EXPORT_FTP_ADDRESS')
 FILE_NAME_FOR_EXPORT = os.environ.get('FILE_NAME_FOR_EXPORT')
+# Gzip the export file while it is uploaded, its name gets a .gz suffix
+EXPORT_COMPRESS = os.environ.get('EXPORT_COMPRESS', '').lower() in ('1', 'true', 'yes')
+
+# Per worker FTP connections, seconds
+FTP_POOL_KEEPALIVE = int(os.environ.get('FTP_POOL_KEEPALIVE', 30))
+FTP_POOL_MAX_IDLE = int(os.environ.get('FTP_POOL_MAX_IDLE', 240))
+FTP_LISTING_TTL = int(os.environ.get('FTP_LISTING_TTL', 20))
+
+# Port of the prometheus HTTP server of a celery worker, 0 to disable
+WORKER_METRICS_PORT = int(os.environ.get('WORKER_METRICS_PORT', 0))
+# /metrics/ of the web app answers these addresses, and any request with 'Authorization: Bearer <METRICS_TOKEN>'.
+# None by default: behind a reverse proxy on the same host every client has the address of the proxy
+METRICS_ALLOWED_IPS = [ip for ip in os.environ.get('METRICS_ALLOWED_IPS', '').split(',') if ip]
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Parse the import file while it is downloaded instead of saving it to disk first
+IMPORT_STREAMING = os.environ.get('IMPORT_STREAMING', '').lower() in ('1', 'true', 'yes')
+IMPORT_CSV_CHUNKSIZE = int(os.environ.get('IMPORT_CSV_CHUNKSIZE', 5000))
+IMPORT_WRITE_BATCH_SIZE = int(os.environ.get('IMPORT_WRITE_BATCH_SIZE', 1000))
+# Parse engine of downloaded import files: csv below the first size, pyarrow (when installed) from the second,
+# pandas in between; or one of csv, pandas, pyarrow for every file
+IMPORT_PARSE_ENGINE = os.environ.get('IMPORT_PARSE_ENGINE', 'auto')
+IMPORT_PARSE_CSV_MAX_BYTES = int(os.environ.get('IMPORT_PARSE_CSV_MAX_BYTES', 1024 * 1024))
+IMPORT_PARSE_PYARROW_MIN_BYTES = int(os.environ.get('IMPORT_PARSE_PYARROW_MIN_BYTES', 64 * 1024 * 1024))
+# Import files are downloaded here, a failed task resumes its download on retry; leftovers are removed after max age
+IMPORT_DOWNLOAD_DIR = os.environ.get('IMPORT_DOWNLOAD_DIR', os.path.join(tempfile.gettempdir(), 'albo-import'))
+IMPORT_DOWNLOAD_MAX_AGE = int(os.environ.get('IMPORT_DOWNLOAD_MAX_AGE', 60 * 60 * 24))
+# Seconds an import run holds its lock without a heartbeat, a run of a dead worker is unlocked after it
+IMPORT_LOCK_LEASE = int(os.environ.get('IMPORT_LOCK_LEASE', 300))
+# Seconds a run requested while an import holds the lock waits for it, a stale request expires after them
+IMPORT_PENDING_TIMEOUT = int(os.environ.get('IMPORT_PENDING_TIMEOUT', 60 * 60))
+
+# Login/logout tracking is written in batches of this size or every interval seconds, 1 to write in the request
+ACTIVITY_FLUSH_SIZE = int(os.environ.get('ACTIVITY_FLUSH_SIZE', 100))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 5))
+# Events waiting beyond this many drop the oldest, the buffer does not grow while the database is unreachable
+ACTIVITY_MAX_EVENTS = int(os.environ.get('ACTIVITY_MAX_EVENTS', 10_000))
+
+# Customer price lists, built by a celery worker and served by the admin, the directory must be shared by both
+PRICE_LIST_ROOT = os.environ.get('PRICE_LIST_ROOT', BASE_DIR / 'price_lists')
+PRICE_LIST_TIMEOUT = int(os.environ.get('PRICE_LIST_TIMEOUT', 60 * 60))
+
+# Catalog changelist pages and filter values are cached this long, or until the next import or product save
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 60 * 60))
 
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
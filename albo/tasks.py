@@ -1,84 +1,362 @@
 import csv
 import ftplib
+import hashlib
+import io
 import os
+import re
+import threading
+import time
+import zlib
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import islice
+from uuid import uuid4
+from django.conf import settings
+from django.db import connection, transaction
 from django.utils import timezone
-import pandas as pd
+from celery import chord, group
 from celery.utils.log import get_task_logger
 
+from albo import parsers
 from albo.celery import app
+from albo.ftp_pool import ftp_pool
+from albo.locks import CacheLock
+from albo.metrics import CSV_ROWS, DB_ROWS, FTP_TRANSFER_BYTES, IMPORT_LAG_SECONDS, IMPORT_RUNS, MAPPING_CODES
+from albo.timing import stage
 
 from user_app import models
+from user_app.caching import get_code_index, invalidate_catalog
+from user_app.price_list import build_price_list
 logger_celery = get_task_logger(__name__)
 
 
-def function_with_try_int(x):
-    try:
-        data = int(x)
-    except ValueError:
-        data = int(''.join(x.split()))
-    return data
+FILENAME_TIME_RE = re.compile(r'_(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})\.csv$')
 
 
 def transform_filename_to_dt(i):
     return datetime.strptime(i.split("_")[-1].split(".")[0], '%Y-%m-%dT%H:%M:%S')
 
 
-def get_last_filename(ftp):
+def get_filename_key(filename):
+    match = FILENAME_TIME_RE.search(filename)
+    return match.group(1) if match else None
+
+
+def get_last_filename(list_files, newer_than=None):
+    """Return the newest import file, or None when there is none from `newer_than` on.
+
+    The ISO timestamps in the names sort lexically, so one pass comparing strings finds the newest
+    file without parsing dates. Names without a timestamp are skipped.
+    """
     logger_celery.debug('get func get_last_filename')
-    list_data_ftp = [i for i in ftp.nlst() if i.endswith('.csv')]
-    sort_list_file = sorted(list_data_ftp, key=transform_filename_to_dt)
-    filename_last = sort_list_file[-1]
+    filename_last, key_last = None, newer_than or ''
+    list_skipped = []
+
+    for filename in list_files:
+        key = get_filename_key(filename)
+        if key is None:
+            list_skipped.append(filename)
+        elif key >= key_last:
+            filename_last, key_last = filename, key
+
+    if list_skipped:
+        logger_celery.debug('skip files without a timestamp - %s' % ', '.join(list_skipped[:10]))
     logger_celery.debug('out func get_last_filename - %s' % filename_last)
     return filename_last
 
 
-def get_file_ftp(import_ftp_data):
-    import_ftp_data_list = import_ftp_data.split(':')
-    logger_celery.debug('get func get_file_ftp')
-    ftp = ftplib.FTP(*import_ftp_data_list)
+def get_source_name(ftp_data):
+    # host and user only, the password must not end up in the database
+    return ':'.join(ftp_data.split(':')[:2])
 
-    file = get_last_filename(ftp)
 
-    with open(file, 'wb') as f:
-        ftp.retrbinary('RETR ' + file, f.write)
+def get_file_marker(ftp, file, facts=None):
+    facts = facts or {}
+    if 'size' in facts and 'modify' in facts:
+        return {'filename': file, 'size': int(facts['size']), 'modify': facts['modify']}
 
-    ftp.quit()
-    logger_celery.debug('out func get_file_ftp')
-    return file
+    size, modify = None, ''
+    try:
+        ftp.voidcmd('TYPE I')
+        size = ftp.size(file)
+    except ftplib.error_perm:
+        pass
+    try:
+        modify = ftp.voidcmd('MDTM ' + file).split()[-1]
+    except ftplib.error_perm:
+        pass
+    return {'filename': file, 'size': size, 'modify': modify}
 
 
-def read_csv(file):
-    df = pd.read_csv(file, delimiter=';')
-    my_df = df.copy()
+def counted_write(write, direction='download'):
+    counter = FTP_TRANSFER_BYTES.labels(direction)
 
-    my_df[my_df.columns[1]] = my_df[my_df.columns[1]].apply(function_with_try_int)
-    dict_code_1C = my_df.set_index(my_df.columns[0])[my_df.columns[1]].to_dict()
+    def wrapper(block):
+        counter.inc(len(block))
+        return write(block)
+    return wrapper
 
-    tuple_code_for_map = models.OneCCodeModel.objects.filter(uniq_code_one_c__in=dict_code_1C.keys()).values_list(
-        'uniq_code_one_c', 'map_code__uniq_code')
-    my_dict = defaultdict(int)
 
-    for key, value in tuple_code_for_map:
-        my_dict[value] += dict_code_1C[key]
+class DownloadVerifyError(ftplib.Error):
+    """The downloaded file does not match the size or the MD5 reported by the server."""
 
-    os.remove(file)
-    return my_dict
+
+# transient failures of a download, a missing file or a refused login (error_perm) is not retried
+DOWNLOAD_RETRY_ERRORS = (ftplib.error_temp, ftplib.error_reply, ftplib.error_proto, OSError, EOFError,
+                         DownloadVerifyError)
+MD5_RE = re.compile(r'\b[0-9a-fA-F]{32}\b')
 
 
-def write_result_in_base(data):
-    list_model = models.AlboProductModel.objects.filter(uniq_code__in=data.keys())
-    
-    for obj_model in list_model:
-        obj_model.quantity = data.get(obj_model.uniq_code)
-    if list_model.exists():
-        models.AlboProductModel.objects.bulk_update(list_model, ['quantity'])
+def get_download_path(task_id, file):
+    """Return the path of the download of file by a task, the same for every retry of the task."""
+    directory = settings.IMPORT_DOWNLOAD_DIR
+    os.makedirs(directory, exist_ok=True)
+    # downloads of tasks that ran out of retries
+    expired = time.time() - settings.IMPORT_DOWNLOAD_MAX_AGE
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.stat().st_mtime < expired:
+            os.remove(entry.path)
+    return os.path.join(directory, f'{task_id or uuid4().hex}-{os.path.basename(file)}')
+
+
+def get_remote_md5(ftp, file):
+    """Return the MD5 of the remote file from the XMD5 or MD5 command, None when neither is supported."""
+    for command in ('XMD5', 'MD5'):
+        try:
+            match = MD5_RE.search(ftp.sendcmd(f'{command} {file}'))
+        except ftplib.error_perm:
+            continue
+        if match:
+            return match.group().lower()
+    return None
+
+
+def get_local_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f_obj:
+        for block in iter(lambda: f_obj.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_file_ftp(ftp, file, path=None, size=None):
+    """Download file to path and return the path.
+
+    A partial download left at path by a failed attempt is resumed with REST from its end.
+    The result is checked against the size of the listing and the MD5 of the server where
+    they are known; a mismatch removes it and raises DownloadVerifyError.
+    """
+    logger_celery.debug('get func get_file_ftp')
+    path = path or file
+
+    with stage('download'), open(path, 'ab') as f:
+        offset = f.tell()
+        if size is None or offset < size:
+            if offset:
+                logger_celery.info('resume download of %s from byte %s' % (file, offset))
+            try:
+                ftp.retrbinary('RETR ' + file, counted_write(f.write), rest=offset or None)
+            except ftplib.error_perm:
+                if not offset:
+                    raise
+                logger_celery.info('REST is refused, download %s from the start' % file)
+                f.truncate(0)
+                ftp.retrbinary('RETR ' + file, counted_write(f.write))
+
+    with stage('verify'):
+        local_size = os.path.getsize(path)
+        error = None
+        if size is not None and local_size != size:
+            error = 'size %s, expected %s' % (local_size, size)
+        else:
+            remote_md5 = get_remote_md5(ftp, file)
+            if remote_md5 and remote_md5 != get_local_md5(path):
+                error = 'MD5 differs from the server'
+        if error:
+            os.remove(path)
+            raise DownloadVerifyError('%s: %s' % (file, error))
+
+    logger_celery.debug('out func get_file_ftp')
+    return path
+
+
+def stream_file_ftp(ftp, file, chunksize):
+    """Yield DataFrame chunks of the file while it is still being downloaded.
+
+    The FTP transfer runs in a thread writing into a pipe, so at most one pipe buffer
+    and one chunk of rows are held in memory and nothing is written to disk.
+    """
+    import pandas as pd
+
+    logger_celery.debug('get func stream_file_ftp')
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def transfer():
+        with open(write_fd, 'wb', buffering=0) as pipe_in:
+            try:
+                ftp.retrbinary('RETR ' + file, counted_write(pipe_in.write))
+            except Exception as exc:
+                errors.append(exc)
+
+    thread = threading.Thread(target=transfer, name=f'ftp-stream-{file}', daemon=True)
+    thread.start()
+    pipe_out = open(read_fd, 'rb')
+    try:
+        with pd.read_csv(pipe_out, delimiter=';', dtype={0: str}, usecols=[0, 1], chunksize=chunksize) as reader:
+            while True:
+                # download and parse interleave here, they are timed as one stage
+                with stage('stream'):
+                    chunk = next(reader, None)
+                if chunk is None:
+                    break
+                yield chunk
+    finally:
+        # closing the read end unblocks the transfer thread if the parsing stopped early
+        pipe_out.close()
+        thread.join()
+
+    if errors:
+        # a broken transfer looks like a short file to the parser, never import it
+        raise errors[0]
+    logger_celery.debug('out func stream_file_ftp - %s' % file)
+
+
+def clean_quantity(column):
+    """Turn a quantity column like '1 234' into int64 without a Python call per row."""
+    import pandas as pd
+
+    if pd.api.types.is_numeric_dtype(column):
+        return column.astype('int64')
+    return pd.to_numeric(column.astype(str).str.replace(r'\s+', '', regex=True)).astype('int64')
+
+
+class QuantityAggregator:
+    """Sum quantities of the 1C codes per UniqCodeModel code, one chunk of rows at a time.
+
+    A 1C code repeated in the file keeps its last quantity, as if the whole file was read at once:
+    the last quantity of every mapped 1C code is kept in an array and each chunk adds only its delta.
+    """
+
+    def __init__(self):
+        import numpy as np
+        import pandas as pd
+
+        with stage('map'):
+            code_index = get_code_index()
+            self._code_frame = pd.Series(code_index, dtype=object).explode().rename('uniq_code').rename_axis(
+                'code_1c').reset_index()
+            self._codes = pd.Index(code_index.keys())
+        self._last = np.zeros(len(self._codes), dtype='int64')
+        self._totals = pd.Series(dtype='int64')
+
+    def add(self, df):
+        import pandas as pd
+
+        with stage('parse'):
+            quantity = pd.Series(clean_quantity(df[df.columns[1]]).to_numpy(), index=df[df.columns[0]].to_numpy())
+            quantity = quantity[~quantity.index.duplicated(keep='last')]
+
+        with stage('map'):
+            position = self._codes.get_indexer(quantity.index)
+            mapped = position >= 0
+            CSV_ROWS.inc(len(df))
+            MAPPING_CODES.labels('hit').inc(int(mapped.sum()))
+            MAPPING_CODES.labels('miss').inc(int(len(mapped) - mapped.sum()))
+            position = position[mapped]
+            value = quantity.to_numpy()[mapped]
+
+            delta = pd.DataFrame({'code_1c': self._codes[position], 'delta': value - self._last[position]})
+            self._last[position] = value
+            delta = delta.merge(self._code_frame, on='code_1c')
+
+        with stage('aggregate'):
+            chunk_totals = delta.groupby('uniq_code')['delta'].sum()
+            self._totals = self._totals.add(chunk_totals, fill_value=0)
+
+    @property
+    def result(self):
+        return self._totals.astype('int64').to_dict()
+
+
+def aggregate_quantities(quantities, rows):
+    """Sum {code_1c: quantity} per UniqCodeModel code, QuantityAggregator without pandas for small files."""
+    with stage('map'):
+        code_index = get_code_index()
+        mapped = [(code_index[code], quantity) for code, quantity in quantities.items() if code_index.get(code)]
+    CSV_ROWS.inc(rows)
+    MAPPING_CODES.labels('hit').inc(len(mapped))
+    MAPPING_CODES.labels('miss').inc(len(quantities) - len(mapped))
+
+    with stage('aggregate'):
+        totals = defaultdict(int)
+        for list_uniq_code, quantity in mapped:
+            for uniq_code in list_uniq_code:
+                totals[uniq_code] += quantity
+    return dict(totals)
+
+
+def read_csv(file, engine=None):
+    """Aggregate an import file with the parse engine for its size, then remove it."""
+    engine = engine or parsers.choose_engine(os.path.getsize(file))
+    logger_celery.debug('parse %s with the %s engine' % (file, engine))
+    if engine == 'csv':
+        with stage('parse'):
+            quantities, rows = parsers.parse_csv(file)
+        result = aggregate_quantities(quantities, rows)
+    else:
+        with stage('parse'):
+            df = parsers.parse_pyarrow(file) if engine == 'pyarrow' else parsers.parse_pandas(file)
+        aggregator = QuantityAggregator()
+        aggregator.add(df)
+        result = aggregator.result
+
+    os.remove(file)
+    return result
+
+
+def read_csv_stream(ftp, file, chunksize=None):
+    aggregator = QuantityAggregator()
+    for chunk in stream_file_ftp(ftp, file, chunksize or settings.IMPORT_CSV_CHUNKSIZE):
+        aggregator.add(chunk)
+    return aggregator.result
+
+
+def write_result_in_base(data, batch_size=None):
+    """Set AlboProductModel.quantity by product code and return the number of updated rows.
+
+    Batches of codes are written in one transaction: a join against a VALUES list on PostgreSQL,
+    a prepared UPDATE through executemany elsewhere. The ORM bulk_update is avoided because its
+    CASE WHEN statement grows with every row.
+    """
+    batch_size = batch_size or settings.IMPORT_WRITE_BATCH_SIZE
+    opts = models.AlboProductModel._meta
+    table = connection.ops.quote_name(opts.db_table)
+    quantity = connection.ops.quote_name(opts.get_field('quantity').column)
+    uniq_code = connection.ops.quote_name(opts.get_field('uniq_code').column)
+
+    list_data = list(data.items())
+    count = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(list_data), batch_size):
+            batch = list_data[start:start + batch_size]
+            if connection.vendor == 'postgresql':
+                values = ', '.join(['(%s, %s::integer)'] * len(batch))
+                cursor.execute(
+                    f'UPDATE {table} AS p SET {quantity} = v.quantity '
+                    f'FROM (VALUES {values}) AS v (uniq_code, quantity) WHERE p.{uniq_code} = v.uniq_code',
+                    [param for pair in batch for param in pair],
+                )
+            else:
+                cursor.executemany(f'UPDATE {table} SET {quantity} = %s WHERE {uniq_code} = %s',
+                                   [(value, key) for key, value in batch])
+            count += cursor.rowcount
+    return count
 
 
 def dict_writer(data, filename):
-    write_result_in_base(data)
-    with open(filename, "w", encoding="utf-8") as f_obj:
+    with stage('csv_write'), open(filename, "w", encoding="utf-8") as f_obj:
         writer = csv.writer(f_obj, delimiter=';')
 
         for key, value in data.items():
@@ -92,34 +370,246 @@ def get_filename(filename, _type):
     return f'{name_file}_{dt_now:{pattern_date}}' + _type, dt_now
 
 
-def export_file_ftp(file_csv: str, export_ftp_data, _type: str = None, filename_for_export=None):
-    logger_celery.debug('get func import_file-%s' % file_csv)
-
-    export_ftp_data_list = export_ftp_data.split(':')
-    ftp = ftplib.FTP(*export_ftp_data_list)
-
-    file = open(filename_for_export, 'rb')
-    filename, dt_now = get_filename(file_csv, _type)  # file to send
-
+class RowReader(io.RawIOBase):
+    """Readable file of the ;-delimited rows of data, gzip compressed on the fly when compress.
+
+    Rows are formatted chunk by chunk as storbinary reads, nothing is written to disk.
+    """
+
+    def __init__(self, data, compress=False, chunk_rows=5000):
+        self._chunks = self._iter_chunks(data, chunk_rows)
+        self._compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+        self._buffer = bytearray()
+        self._done = False
+
+    @staticmethod
+    def _iter_chunks(data, chunk_rows):
+        text = io.StringIO()
+        writer = csv.writer(text, delimiter=';')
+        items = iter(data.items())
+        while True:
+            writer.writerows(islice(items, chunk_rows))
+            if not text.tell():
+                return
+            yield text.getvalue().encode('utf-8')
+            text.seek(0)
+            text.truncate()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self._done and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                if self._compressor:
+                    self._buffer += self._compressor.flush()
+                self._done = True
+            else:
+                self._buffer += self._compressor.compress(chunk) if self._compressor else chunk
+        if size is None or size < 0:
+            size = len(self._buffer)
+        block = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return block
+
+
+def export_file_ftp(data, export_ftp_data, filename_for_export, _type='csv', compress=False):
+    """Upload data as a new export file and return the time of its name.
+
+    The file is stored under a temporary name and renamed when complete, so a reader of the
+    export directory never sees a partial file.
+    """
+    filename, dt_now = get_filename(os.path.basename(filename_for_export), f'.{_type}')  # file to send
+    if compress:
+        filename += '.gz'
+    temp_filename = f'.{filename}.{uuid4().hex[:8]}.part'
     logger_celery.debug('-- filename-%s' % filename)
-    ftpResponseMessage = ftp.storbinary(f'STOR {filename}', file)  # send the file
-    logger_celery.debug('-- STOR filename-%s' % f'STOR {filename}')
 
-    ftp_list_files = ftp.nlst()
-    logger_celery.debug(f'{len(ftp_list_files)}')
+    try:
+        with stage('export'), ftp_pool.connection(export_ftp_data) as ftp:
+            ftpResponseMessage = ftp.storbinary(f'STOR {temp_filename}', RowReader(data, compress),
+                                                callback=counted_write(lambda block: None, 'upload'))
+            ftp.rename(temp_filename, filename)
+    except ftplib.all_errors:
+        # over another connection, the one of an interrupted STOR still has its reply unread
+        try:
+            with ftp_pool.connection(export_ftp_data) as ftp:
+                ftp.delete(temp_filename)
+        except ftplib.all_errors:
+            logger_celery.warning('temporary export file %s is left on the server' % temp_filename)
+        raise
+    ftp_pool.invalidate_listing(export_ftp_data)
     logger_celery.debug(f'ftpResponseMessage - {ftpResponseMessage}')
-    logger_celery.debug(f'{filename} in nlst ------ {filename in ftp_list_files}')
-    file.close()
-    ftp.quit()
-
-    models.PeriodicTimeModel.objects.update(**{'last_time': dt_now})
+    return dt_now
+
+
+MERGED_SOURCE = models.ImportStateModel.MERGED_SOURCE
+
+
+import_lock = CacheLock('task_export', settings.IMPORT_LOCK_LEASE, settings.IMPORT_PENDING_TIMEOUT)
+
+
+@app.task(bind=True, autoretry_for=DOWNLOAD_RETRY_ERRORS, retry_backoff=True, retry_backoff_max=60,
+          retry_jitter=True, max_retries=5)
+def task_import_source(self, import_ftp_address: str, streaming=None, lock_token=None):
+    """Aggregate the newest file of one FTP source.
+
+    Returns the source name, the file marker and the quantities, or only the source name
+    with changed=False when that file is already imported. A transfer that fails is retried
+    with backoff and resumes the download of the previous attempt.
+    """
+    if streaming is None:
+        streaming = settings.IMPORT_STREAMING
+    source = get_source_name(import_ftp_address)
+    state = models.ImportStateModel.objects.filter(source=source).first()
+
+    with import_lock.heartbeat(lock_token), ftp_pool.connection(import_ftp_address) as ftp:
+        with stage('list'):
+            dict_files = ftp_pool.listing(import_ftp_address, ftp)
+            file_last = get_last_filename(dict_files, newer_than=state and get_filename_key(state.filename))
+            marker = file_last and get_file_marker(ftp, file_last, dict_files[file_last])
+        if file_last is None:
+            logger_celery.debug('no new files on %s' % source)
+            return {'source': source, 'changed': False}
+        if state and state.is_same_file(marker):
+            logger_celery.debug('file %s is already imported' % file_last)
+            return {'source': source, 'changed': False}
+        if streaming:
+            dict_to_write = read_csv_stream(ftp, file_last)
+        else:
+            path = get_download_path(self.request.id, file_last)
+            dict_to_write = read_csv(get_file_ftp(ftp, file_last, path, marker['size']))
+
+    return {'source': source, 'changed': True, 'marker': marker, 'data': dict_to_write}
+
+
+def save_import_state(source, data, marker=None):
+    state, _ = models.ImportStateModel.objects.get_or_create(source=source)
+    if marker:
+        for key, value in marker.items():
+            setattr(state, key, value)
+        state.file_time = timezone.make_aware(transform_filename_to_dt(marker['filename']))
+    state.snapshot = data
+    state.save()
+    return state
+
+
+@app.task
+def task_merge_sources(results, export_ftp_address: str = '', filename_for_export: str = '', _type='csv',
+                       lock_token=None):
+    """Sum the quantities of all sources and write the codes that changed since the last import."""
+    try:
+        with import_lock.heartbeat(lock_token):
+            merge_sources(results, export_ftp_address, filename_for_export, _type)
+    finally:
+        release_import_lock(lock_token)
+
+
+@app.task
+def task_release_import_lock(request, exc, traceback, lock_token=None):
+    """Errback of a failed import run, the merge that releases the lock does not run then."""
+    release_import_lock(lock_token)
+
+
+def release_import_lock(lock_token):
+    pending = import_lock.release(lock_token)
+    if pending is not None:
+        logger_celery.info('starting the import requested during the last run')
+        task_export.apply_async(kwargs=pending)
+
+
+def merge_sources(results, export_ftp_address, filename_for_export, _type='csv'):
+    if not any(result['changed'] for result in results):
+        IMPORT_RUNS.labels('unchanged').inc()
+        return
+
+    states = models.ImportStateModel.objects.in_bulk([result['source'] for result in results] + [MERGED_SOURCE],
+                                                     field_name='source')
+    dict_to_write = defaultdict(int)
+    for result in results:
+        if result['changed']:
+            data = result['data']
+        elif result['source'] in states:
+            data = states[result['source']].snapshot
+        else:
+            continue
+        for key, value in data.items():
+            dict_to_write[key] += value
+
+    merged_state = states.get(MERGED_SOURCE) or models.ImportStateModel(source=MERGED_SOURCE)
+    dict_changed = merged_state.get_changed(dict_to_write)
+    logger_celery.debug('%s codes changed of %s' % (len(dict_changed), len(dict_to_write)))
+
+    # the export does not wait for the database, it runs in a thread next to the write
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if export_ftp_address:
+            export = executor.submit(export_file_ftp, dict_to_write, export_ftp_address, filename_for_export, _type,
+                                     settings.EXPORT_COMPRESS)
+        else:
+            export = executor.submit(dict_writer, dict_to_write, filename_for_export)
+
+        if dict_changed:
+            # a short transaction of its own, other writers do not wait for the upload
+            with stage('db_write'):
+                count = write_result_in_base(dict_changed)
+            DB_ROWS.inc(count)
+            logger_celery.debug('%s products updated' % count)
+            # the quantities are written by raw SQL, the cached catalog pages are dropped here
+            invalidate_catalog()
+        dt_export = export.result()
+
+    # saved only after the export, a failed one leaves the files unread and the next run writes
+    # the same quantities again and retries the export
+    with transaction.atomic():
+        for result in results:
+            if result['changed']:
+                save_import_state(result['source'], result['data'], result['marker'])
+        save_import_state(MERGED_SOURCE, dict_to_write)
+
+    IMPORT_RUNS.labels('imported').inc()
+    for result in results:
+        if result['changed']:
+            file_time = timezone.make_aware(transform_filename_to_dt(result['marker']['filename']))
+            IMPORT_LAG_SECONDS.observe((timezone.now() - file_time).total_seconds())
+    if export_ftp_address:
+        models.PeriodicTimeModel.objects.update(last_time=dt_export)
 
 
 @app.task(bind=True)
-def task_export(*args, import_ftp_address: str = '', export_ftp_address: str = '', filename_for_export: str = '',
-                _type='csv', **kwargs):
-    file_last = get_file_ftp(import_ftp_address)
-    dict_to_write = read_csv(file_last)
-    dict_writer(dict_to_write, filename_for_export)
-    # export_file_ftp(import_ftp_address, export_ftp_address, filename_for_export)
+def task_export(*args, import_ftp_address: str = '', import_ftp_addresses=None, export_ftp_address: str = '',
+                filename_for_export: str = '', _type='csv', streaming=None, **kwargs):
+    """Import every FTP source in parallel and write their summed quantities once.
+
+    Only one run holds the import lock at a time. Triggers arriving during a run are folded
+    into a single run started when it ends: the first one is counted as coalesced, the
+    following ones as skipped.
+    """
+    lock_token = import_lock.acquire()
+    if lock_token is None:
+        arguments = {'import_ftp_address': import_ftp_address, 'import_ftp_addresses': import_ftp_addresses,
+                     'export_ftp_address': export_ftp_address, 'filename_for_export': filename_for_export,
+                     '_type': _type, 'streaming': streaming}
+        result = 'coalesced' if import_lock.request_pending(arguments) else 'skipped'
+        IMPORT_RUNS.labels(result).inc()
+        logger_celery.info('an import is running, this one is %s' % result)
+        return {'status': result}
 
+    try:
+        sources = import_ftp_addresses or [import_ftp_address]
+        header = group(task_import_source.s(address, streaming=streaming, lock_token=lock_token)
+                       for address in sources)
+        callback = task_merge_sources.s(export_ftp_address=export_ftp_address,
+                                        filename_for_export=filename_for_export, _type=_type, lock_token=lock_token)
+        callback.on_error(task_release_import_lock.s(lock_token=lock_token))
+        return {'status': 'started', 'id': chord(header)(callback).id}
+    except Exception:
+        release_import_lock(lock_token)
+        raise
+
+
+@app.task
+def task_price_list(discount, list_category_id, _type='xlsx', version=None):
+    """Build the price list shared by the customers with this discount and these visible categories."""
+    with stage('price_list'):
+        return build_price_list(discount, list_category_id, _type, version)
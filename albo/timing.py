@@ -0,0 +1,35 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from celery.utils.log import get_task_logger
+
+from albo.metrics import STAGE_SECONDS
+
+logger_celery = get_task_logger(__name__)
+
+_collectors = []
+
+
+@contextmanager
+def collect_stages():
+    """Collect the seconds spent in every stage run inside the block, {stage: seconds}."""
+    timings = defaultdict(float)
+    _collectors.append(timings)
+    try:
+        yield timings
+    finally:
+        _collectors.remove(timings)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(name).observe(elapsed)
+        for timings in _collectors:
+            timings[name] += elapsed
+        logger_celery.debug('stage %s - %.3fs' % (name, elapsed))
@@ -18,5 +18,8 @@ from django.contrib.admin.sites import all_sites
 
 from django.urls import path
 
+from user_app.views import metrics_view
+
 urlpatterns = [path(f'{site.name}/', site.urls) for site in all_sites]
+urlpatterns.append(path('metrics/', metrics_view, name='metrics'))
 # urlpatterns = i18n_patterns(*urlpatterns)
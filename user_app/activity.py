@@ -0,0 +1,123 @@
+import atexit
+import logging
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityBuffer:
+    """Buffer of login/logout events written to UserActivityTrack in batches.
+
+    Events are flushed by a background thread every ACTIVITY_FLUSH_INTERVAL seconds or as soon
+    as ACTIVITY_FLUSH_SIZE of them are waiting, and once more at interpreter exit. A batch that
+    fails to write is written again event by event and the events that still fail are dropped,
+    so one bad event costs only itself. At most ACTIVITY_MAX_EVENTS wait, the oldest are dropped
+    beyond. ACTIVITY_FLUSH_SIZE = 1 writes every event in the request, as before.
+    """
+
+    def __init__(self, max_events=None):
+        self._events = deque(maxlen=max_events or settings.ACTIVITY_MAX_EVENTS)
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def login(self, user, request):
+        self.put(('login', user.pk, request.session.session_key, timezone.now(),
+                  request.META.get('REMOTE_ADDR'), request.META.get('HTTP_USER_AGENT')))
+
+    def logout(self, user, request):
+        self.put(('logout', user.pk, request.session.session_key, timezone.now()))
+
+    def put(self, event):
+        if len(self._events) == self._events.maxlen:
+            logger.warning('Activity buffer is full, dropping the oldest event')
+        self._events.append(event)
+        if settings.ACTIVITY_FLUSH_SIZE <= 1:
+            self.flush()
+            return
+        self._start()
+        if len(self._events) >= settings.ACTIVITY_FLUSH_SIZE:
+            self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            events = []
+            while self._events:
+                events.append(self._events.popleft())
+            if not events:
+                return
+            try:
+                write_events(events)
+            except Exception:
+                if len(events) == 1:
+                    logger.exception('Failed to write activity event %r, dropping it', events[0])
+                    return
+                logger.warning('Failed to write %s activity events, writing them one by one', len(events),
+                               exc_info=True)
+                for event in events:
+                    try:
+                        write_events([event])
+                    except Exception:
+                        logger.exception('Failed to write activity event %r, dropping it', event)
+
+    def _start(self):
+        # a worker forked from a preloaded master does not inherit the thread
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='activity-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(settings.ACTIVITY_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+            connection.close()
+
+
+def write_events(events):
+    from user_app.models import UserActivityTrack
+
+    logins = {}
+    logouts = {}
+    for event in events:
+        kind, user_id, session_key, time = event[:4]
+        if kind == 'login':
+            ip, user_agent = event[4:]
+            logins[user_id, session_key] = UserActivityTrack(user_id=user_id, session_key=session_key, login=time,
+                                                             ip=ip, user_agent=user_agent)
+        elif (user_id, session_key) in logins:
+            logins[user_id, session_key].logout = time
+        else:
+            logouts[user_id, session_key] = time
+
+    with transaction.atomic():
+        if logins:
+            UserActivityTrack.objects.bulk_create(logins.values())
+        if logouts:
+            # one UPDATE for every logout of the batch, found through the (user, session_key) index
+            UserActivityTrack.objects.filter(
+                user_id__in={user_id for user_id, _ in logouts},
+                session_key__in={session_key for _, session_key in logouts},
+                logout__isnull=True,
+            ).update(logout=Case(
+                *(When(user_id=user_id, session_key=session_key, then=Value(time))
+                  for (user_id, session_key), time in logouts.items()),
+                default=None,
+            ))
+
+
+activity_buffer = ActivityBuffer()
+atexit.register(activity_buffer.flush)
@@ -1,17 +1,60 @@
-import operator
-from functools import reduce
-
-from django.contrib.admin import site, AdminSite, ModelAdmin, TabularInline, StackedInline, SimpleListFilter
+from django import forms
+from django.contrib import messages
+from django.contrib.admin import site, AdminSite, ModelAdmin, TabularInline, StackedInline, SimpleListFilter, display
+from django.contrib.admin.options import IncorrectLookupParameters
 from django.contrib.auth.models import User, Group
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from django.contrib.admin.models import LogEntry
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.hashers import make_password
+from django.db import connections
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.db.models import Aggregate, CharField, F, OuterRef, Q, Subquery
 from user_app.models import MyUser, ProductModel, CategoryProduct, UniqCodeModel, OneCCodeModel, PeriodicTimeModel, \
     CategoryProductExclude, UserActivityTrack, AlboProductModel, OneCCodeAlboModel
+from user_app.caching import filter_category_ids, get_visible_category_ids
+from user_app.catalog_import import import_catalog
+from user_app.changelist import CachedAllValuesFieldListFilter, CatalogCacheAdminMixin, EstimatedCountAdminMixin
+from user_app.paginator import EstimatedKeysetPaginator
+from user_app.price_list import PRICE_LIST_TYPES, get_customer_price, get_price_list, round_price
 
 default_admin = site
+PRICE_LIST_REFRESH = 15
+
+
+def filter_visible_categories(request, queryset, lookup='category_product'):
+    return filter_category_ids(queryset, get_visible_category_ids(request.user), lookup)
+
+
+def annotate_customer_price(request, queryset):
+    # price_sample minus MyUser.discount of the requesting user, computed by the database
+    return queryset.annotate(price_customer=get_customer_price(getattr(request.user, 'discount', 0)))
+
+
+class CustomerPriceListFilter(SimpleListFilter):
+    title = _('Цена со скидкой')
+    parameter_name = 'price_customer'
+    list_range = ((0, 100), (100, 500), (500, 1000), (1000, 5000), (5000, None))
+
+    def lookups(self, request, model_admin):
+        return [(f'{low}-{high or ""}', f'{low} - {high}' if high else f'{low} +') for low, high in self.list_range]
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        ranges = {f'{low}-{high or ""}': (low, high) for low, high in self.list_range}
+        if self.value() not in ranges:
+            # the changelist redirects to ?e=1 as for any other bad lookup
+            raise IncorrectLookupParameters(self.value())
+        low, high = ranges[self.value()]
+        queryset = queryset.filter(price_customer__gte=low)
+        if high:
+            queryset = queryset.filter(price_customer__lt=high)
+        return queryset
 
 
 class CustomAdminBase(AdminSite):
@@ -24,6 +67,25 @@ class CustomAdminBase(AdminSite):
             hasattr(request.user, self.model_name_permission) and \
             getattr(request.user, self.model_name_permission) == self.permissions
 
+    def get_urls(self):
+        return [
+            path('price-list/<str:_type>/', self.admin_view(self.price_list_view), name='price_list'),
+        ] + super().get_urls()
+
+    def price_list_view(self, request, _type):
+        if _type not in PRICE_LIST_TYPES:
+            raise Http404
+        filename = get_price_list(request.user, _type)
+        if filename is None:
+            # the page asks again until the worker has built the file
+            request.current_app = self.name
+            context = {**self.each_context(request), 'title': _('Прайс-лист готовится'),
+                       'refresh': PRICE_LIST_REFRESH}
+            response = TemplateResponse(request, 'admin/price_list_pending.html', context, status=202)
+            response['Refresh'] = str(PRICE_LIST_REFRESH)
+            return response
+        return FileResponse(open(filename, 'rb'), as_attachment=True, filename=f'price_list.{_type}')
+
 
 class GeneralAdminPanel(CustomAdminBase):
     permissions = 'is_admin_general'
@@ -121,10 +183,7 @@ class ProductInline(TabularInline):
     readonly_fields = 'full_url', 'price_uniq', 'image_tag', 'quantity'
 
     def get_queryset(self, request):
-        my_query = super().get_queryset(request)
-        if request.user.categoryproductexclude_set.exists():
-            list_exclude = request.user.categoryproductexclude_set.values_list('exclude_category__name_category')
-            my_query = AlboProductModel.objects.exclude(category_product__name_category__in=list_exclude)
+        my_query = filter_visible_categories(request, super().get_queryset(request))
 
         # list_category = my_query.filter(category_product__name_category__isnull=False).values_list(
         #     'category_product__name_category', flat=True).distinct()
@@ -133,14 +192,10 @@ class ProductInline(TabularInline):
         #     list_query.append(my_query.filter(category_product__name_category=name_category).order_by('size_field'))
         # query_sort = self.model._default_manager.none().union(*list_query)
 
-        return my_query.order_by('size_field')
+        return annotate_customer_price(request, my_query).order_by('size_field')
 
     def price_uniq(self, obj):
-        discount = getattr(self.my_user_form, 'discount', 0)
-        sample_price = obj.price_sample
-        if obj.pk:
-            return round(sample_price - (sample_price * (discount / 100)), 2)
-        return 0
+        return round_price(getattr(obj, 'price_customer', 0))
 
     def url_describe(self, obj):
         print('-' * 300)
@@ -154,7 +209,6 @@ class ProductInline(TabularInline):
         return ''  # mark_safe('<img src="" alt="%s" style="width:60px; height:60px;" />' % "noimagefound")
 
     def formfield_for_dbfield(self, db_field, request, **kwargs):
-        setattr(self, 'my_user_form', request.user)
         return super().formfield_for_choice_field(db_field, request, **kwargs)
 
 
@@ -162,11 +216,7 @@ class CategoryProductAdmin(ModelAdmin):
     inlines = [ProductInline, ]
 
     def get_queryset(self, request):
-        my_query = super().get_queryset(request)
-        if request.user.categoryproductexclude_set.exists():
-            list_exclude = request.user.categoryproductexclude_set.values_list('exclude_category__name_category')
-            my_query = CategoryProduct.objects.exclude(name_category__in=list_exclude)
-        return my_query
+        return filter_visible_categories(request, super().get_queryset(request), lookup='pk')
 
 
 class MyCategoryListFilter(SimpleListFilter):
@@ -186,34 +236,24 @@ class SimpleHistoryShowDeletedFilter(SimpleListFilter):
         )
 
 
-class ProjectProductAdmin(ModelAdmin):
+class ProjectProductAdmin(CatalogCacheAdminMixin, EstimatedCountAdminMixin, ModelAdmin):
     model = ProductModel
     list_display = ("uniq_code", "describe", "price_sample", "price_uniq", "full_url", 'image_tag')
-    list_filter = ('category_product__name_category', "uniq_code", "price_sample",)
+    list_filter = (('category_product__name_category', CachedAllValuesFieldListFilter),
+                   ("uniq_code", CachedAllValuesFieldListFilter), ("price_sample", CachedAllValuesFieldListFilter),
+                   CustomerPriceListFilter)
 
     # list_filter = (SimpleHistoryShowDeletedFilter,)
 
     def get_queryset(self, request):
-        my_query = super().get_queryset(request)
-        if request.user.categoryproductexclude_set.exists():
-            list_exclude = request.user.categoryproductexclude_set.values_list('exclude_category__name_category')
-            my_query = ProductModel.objects.exclude(category_product__name_category__in=list_exclude)
-        return my_query
-
-    def changelist_view(self, request, extra_context=None):
-        # add user in my model admin
-        setattr(self, 'my_user_form', request.user)
-        return super().changelist_view(request, extra_context)
+        return annotate_customer_price(request, filter_visible_categories(request, super().get_queryset(request)))
 
     def name_category_fields(self, obj):
         return obj.category_product.name_category
 
+    @display(description=_('Цена со скидкой'), ordering='price_customer')
     def price_uniq(self, obj):
-        discount = getattr(self.my_user_form, 'discount', 0)
-        return round(obj.price_sample - (obj.price_sample * (discount / 100)), 2)
-
-    def discount(self, obj):
-        return obj.my_user_form.discount
+        return round_price(obj.price_customer)
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
@@ -229,42 +269,66 @@ class OneCCodeAlboModelInlines(StackedInline):
     extra = 1
 
 
-class AlboProductAdmin(ModelAdmin):
+class CatalogImportForm(forms.Form):
+    file = forms.FileField(label=_('Файл XLSX или CSV'))
+    delimiter = forms.CharField(label=_('Разделитель CSV'), max_length=1, required=False, initial=';', strip=False)
+
+
+class AlboProductAdmin(CatalogCacheAdminMixin, EstimatedCountAdminMixin, ModelAdmin):
     inlines = [OneCCodeAlboModelInlines, ]
     model = AlboProductModel
-    list_display = ("uniq_code", "describe", "price_sample", "price_uniq", "full_url", 'image_tag')
-    list_filter = ('category_product__name_category', "uniq_code", "price_sample",)
+    list_display = ("uniq_code", "describe", "name_category_fields", "price_sample", "price_uniq", "full_url",
+                    'image_tag')
+    list_filter = (('category_product__name_category', CachedAllValuesFieldListFilter),
+                   ("uniq_code", CachedAllValuesFieldListFilter), ("price_sample", CachedAllValuesFieldListFilter),
+                   CustomerPriceListFilter)
+    paginator = EstimatedKeysetPaginator
+    change_list_template = 'admin/user_app/alboproductmodel/change_list.html'
 
     # list_filter = (SimpleHistoryShowDeletedFilter,)
 
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            path('import/', self.admin_site.admin_view(self.import_catalog_view), name='%s_%s_import' % info),
+        ] + super().get_urls()
+
+    def import_catalog_view(self, request):
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        request.current_app = self.admin_site.name
+        report = None
+        form = CatalogImportForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            file = form.cleaned_data['file']
+            report = import_catalog(file, file.name, delimiter=form.cleaned_data['delimiter'] or ';')
+            level = messages.WARNING if report['errors'] else messages.SUCCESS
+            messages.add_message(request, level, _(
+                'Строк: %(rows)s, создано: %(created)s, обновлено: %(updated)s, категорий: %(categories)s, '
+                'кодов 1С: %(mappings)s, ошибок: %(errors)s') % {**report, 'errors': len(report['errors'])})
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': _('Импорт каталога'),
+            'form': form,
+            'report': report,
+        }
+        return TemplateResponse(request, 'admin/user_app/alboproductmodel/import_catalog.html', context)
+
     def get_queryset(self, request):
-        my_query = super().get_queryset(request)
-        if request.user.categoryproductexclude_set.exists():
-            list_exclude = request.user.categoryproductexclude_set.values_list('exclude_category__name_category')
-            my_query = AlboProductModel.objects.exclude(category_product__name_category__in=list_exclude)
-
-        list_category = my_query.filter(category_product__name_category__isnull=False).values_list(
-            'category_product__name_category', flat=True).distinct()
-        list_query = []
-        for name_category in list_category:
-            list_query.append(my_query.filter(category_product__name_category=name_category).order_by('size_field'))
-        query_sort = reduce(operator.or_, list_query)
-        return query_sort
-
-    def changelist_view(self, request, extra_context=None):
-        # add user in my model admin
-        setattr(self, 'my_user_form', request.user)
-        return super().changelist_view(request, extra_context)
+        my_query = annotate_customer_price(request, filter_visible_categories(request, super().get_queryset(request)))
+
+        # grouped by category, products without one at the end, sorted by size inside a group
+        return my_query.select_related('category_product').order_by(
+            F('category_product__name_category').asc(nulls_last=True), 'size_field', 'pk')
 
+    @display(description=_('Категория'), ordering='category_product__name_category')
     def name_category_fields(self, obj):
-        return obj.category_product.name_category
+        return obj.category_product and obj.category_product.name_category
 
+    @display(description=_('Цена со скидкой'), ordering='price_customer')
     def price_uniq(self, obj):
-        discount = getattr(self.my_user_form, 'discount', 0)
-        return round(obj.price_sample - (obj.price_sample * (discount / 100)), 2)
-
-    def discount(self, obj):
-        return obj.my_user_form.discount
+        return round_price(obj.price_customer)
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         # if db_field.name == "school":
@@ -272,13 +336,48 @@ class AlboProductAdmin(ModelAdmin):
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
+class GroupConcat(Aggregate):
+    function = 'GROUP_CONCAT'
+    template = '%(function)s(%(distinct)s%(expressions)s)'
+    allow_distinct = True
+    output_field = CharField()
+
+
 class UniqCodeModelAdmin(ModelAdmin):
     inlines = [OneCCodeModelInlines, ]
     list_display = ("uniq_code", 'field_set')
+    search_fields = ("uniq_code", "oneccodemodel__uniq_code_one_c")
+    search_help_text = _('Точный код товара или код 1С')
 
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        vendor = connections[queryset.db].vendor
+        if vendor == 'postgresql':
+            from django.contrib.postgres.aggregates import StringAgg
+            codes = StringAgg('uniq_code_one_c', delimiter=',')
+        elif vendor in ('sqlite', 'mysql'):
+            codes = GroupConcat('uniq_code_one_c')
+        else:
+            return queryset.prefetch_related('oneccodemodel_set')
+
+        # a correlated subquery keeps the changelist COUNT free of any GROUP BY
+        list_code = OneCCodeModel.objects.filter(map_code=OuterRef('pk')).values('map_code').annotate(
+            codes=codes).values('codes')
+        return queryset.annotate(codes_one_c=Subquery(list_code, output_field=CharField()))
+
+    def get_search_results(self, request, queryset, search_term):
+        # exact matches only, both columns are indexed while icontains scans the tables
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        list_id = OneCCodeModel.objects.filter(uniq_code_one_c=search_term).values('map_code_id')
+        return queryset.filter(Q(uniq_code=search_term) | Q(pk__in=list_id)), False
+
+    @display(description=_('Коды 1С'))
     def field_set(self, obj):
-        data = obj.oneccodemodel_set.values_list('uniq_code_one_c', flat=True)
-        return ','.join(data)
+        if hasattr(obj, 'codes_one_c'):
+            return obj.codes_one_c or ''
+        return ','.join(i.uniq_code_one_c for i in obj.oneccodemodel_set.all())
 
 
 class CategoryProductExcludeAdmin(ModelAdmin):
@@ -325,8 +424,9 @@ customer_admin.register(CategoryProduct, CategoryProductAdmin)
 customer_admin.register(AlboProductModel, AlboProductAdmin)
 
 
-class LogEntryAdmin(ModelAdmin):
+class LogEntryAdmin(EstimatedCountAdminMixin, ModelAdmin):
     date_hierarchy = 'action_time'
+    list_select_related = ('user', 'content_type')
 
     list_filter = [
         'user',
@@ -347,6 +447,10 @@ class LogEntryAdmin(ModelAdmin):
     ]
 
 
+class UserActivityTrackAdmin(EstimatedCountAdminMixin, ModelAdmin):
+    list_select_related = ('user',)
+
+
 default_admin.register(LogEntry, LogEntryAdmin)
-general_admin.register(UserActivityTrack)
-default_admin.register(UserActivityTrack)
+general_admin.register(UserActivityTrack, UserActivityTrackAdmin)
+default_admin.register(UserActivityTrack, UserActivityTrackAdmin)
@@ -0,0 +1,97 @@
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db.models import Q
+
+from user_app import models
+
+CODE_INDEX_VERSION_KEY = 'code-index:version'
+CODE_INDEX_TIMEOUT = 60 * 60 * 24
+VISIBLE_CATEGORIES_VERSION_KEY = 'visible-categories:version'
+VISIBLE_CATEGORIES_TIMEOUT = 60 * 60
+CATALOG_VERSION_KEY = 'catalog:version'
+
+_local_code_index = {'version': None, 'index': None}
+
+
+def build_code_index():
+    index = {}
+    for code_one_c, uniq_code in models.OneCCodeModel.objects.values_list('uniq_code_one_c', 'map_code__uniq_code'):
+        index.setdefault(code_one_c, []).append(uniq_code)
+    return index
+
+
+def get_code_index():
+    """Return the mapping {1C code: [UniqCodeModel code, ...]} used by the import.
+
+    The index is kept in the cache under a version token and memoized in the process,
+    so it is rebuilt from the database only after the mapping tables change.
+    """
+    version = cache.get(CODE_INDEX_VERSION_KEY)
+    if version is None:
+        version = invalidate_code_index()
+    if _local_code_index['version'] == version:
+        return _local_code_index['index']
+
+    index = cache.get(f'code-index:{version}')
+    if index is None:
+        index = build_code_index()
+        cache.set(f'code-index:{version}', index, CODE_INDEX_TIMEOUT)
+    _local_code_index.update(version=version, index=index)
+    return index
+
+
+def invalidate_code_index():
+    # a fresh token rather than a counter, so a lost version key never revives an old index
+    version = uuid4().hex
+    cache.set(CODE_INDEX_VERSION_KEY, version, None)
+    return version
+
+
+def get_visible_category_ids(user):
+    """Return the sorted ids of the categories the user may see, None when nothing is excluded.
+
+    Cached per user until a CategoryProductExclude or CategoryProduct changes.
+    """
+    version = cache.get(VISIBLE_CATEGORIES_VERSION_KEY) or invalidate_visible_categories()
+    key = f'visible-categories:{version}:{user.pk}'
+    data = cache.get(key)
+    if data is None:
+        set_exclude = set(user.categoryproductexclude_set.values_list('exclude_category_id', flat=True)) - {None}
+        list_id = None
+        if set_exclude:
+            list_id = sorted(set(models.CategoryProduct.objects.values_list('id', flat=True)) - set_exclude)
+        # wrapped, a cached None must not look like a miss
+        data = {'ids': list_id}
+        cache.set(key, data, VISIBLE_CATEGORIES_TIMEOUT)
+    return data['ids']
+
+
+def filter_category_ids(queryset, list_id, lookup='category_product'):
+    """Filter queryset to the ids of get_visible_category_ids, lookup is the category relation or 'pk'."""
+    # products without a category stay visible, as with the exclusion by name before
+    if list_id is None:
+        return queryset
+    if lookup == 'pk':
+        return queryset.filter(pk__in=list_id)
+    return queryset.filter(Q(**{f'{lookup}_id__in': list_id}) | Q(**{f'{lookup}__isnull': True}))
+
+
+def invalidate_visible_categories():
+    version = uuid4().hex
+    cache.set(VISIBLE_CATEGORIES_VERSION_KEY, version, None)
+    return version
+
+
+def get_catalog_version():
+    """Return the token of the current catalog, changed after every write to the products.
+
+    Cached catalog pages are keyed on it, so one bump drops all of them at once.
+    """
+    return cache.get(CATALOG_VERSION_KEY) or invalidate_catalog()
+
+
+def invalidate_catalog():
+    version = uuid4().hex
+    cache.set(CATALOG_VERSION_KEY, version, None)
+    return version
@@ -0,0 +1,270 @@
+import codecs
+import csv
+import re
+import zipfile
+
+from django.db import DatabaseError, transaction
+
+from user_app.caching import invalidate_catalog, invalidate_code_index, invalidate_visible_categories
+from user_app.models import AlboProductModel, CategoryProduct, ImportStateModel, OneCCodeAlboModel, OneCCodeModel, \
+    UniqCodeModel
+
+CATALOG_IMPORT_BATCH_SIZE = 1000
+PRODUCT_FIELDS = ('describe', 'url_describe', 'url_image_albo', 'price_sample', 'size_field')
+FLOAT_FIELDS = ('price_sample', 'size_field')
+CODES_SEPARATOR_RE = re.compile(r'[\s,;]+')
+# enough of a CSV file to tell UTF-8 from the cp1251 of Excel and 1C
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+
+class CatalogFileError(Exception):
+    """The import file can not be read as XLSX or CSV."""
+
+
+def get_column_names():
+    """Map the accepted header names, field names or verbose names in any case, to row keys."""
+    names = {'category': 'category', 'codes_1c': 'codes_1c'}
+    for model, name, key in ((CategoryProduct, 'name_category', 'category'),
+                             (OneCCodeAlboModel, 'uniq_code_one_c', 'codes_1c')):
+        names[name] = key
+        names[str(model._meta.get_field(name).verbose_name).lower()] = key
+    for name in ('uniq_code',) + PRODUCT_FIELDS:
+        names[name] = name
+        names[str(AlboProductModel._meta.get_field(name).verbose_name).lower()] = name
+    return names
+
+
+def detect_encoding(file):
+    """Return utf-8-sig when the start of file decodes as UTF-8, otherwise cp1251."""
+    sample = file.read(ENCODING_SAMPLE_SIZE)
+    file.seek(0)
+    try:
+        codecs.getincrementaldecoder('utf-8-sig')().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return 'cp1251'
+    return 'utf-8-sig'
+
+
+def iter_rows(file, filename, delimiter=';'):
+    """Yield the rows of an XLSX or CSV file as tuples, reading it sheet row by sheet row.
+
+    Raises CatalogFileError when the file is not a workbook or its text can not be decoded.
+    """
+    if filename.lower().endswith('.xlsx'):
+        from openpyxl import load_workbook
+
+        try:
+            workbook = load_workbook(file, read_only=True, data_only=True)
+        except (zipfile.BadZipFile, KeyError, OSError, ValueError) as error:
+            raise CatalogFileError(f'not an XLSX file: {error}') from error
+        try:
+            yield from workbook.active.iter_rows(values_only=True)
+        except (zipfile.BadZipFile, KeyError, SyntaxError, ValueError) as error:
+            raise CatalogFileError(f'the workbook is damaged: {error}') from error
+        finally:
+            workbook.close()
+    else:
+        try:
+            yield from csv.reader(codecs.iterdecode(file, detect_encoding(file)), delimiter=delimiter)
+        except (UnicodeDecodeError, csv.Error) as error:
+            raise CatalogFileError(f'not a CSV file in UTF-8 or cp1251: {error}') from error
+
+
+def to_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def to_float(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = re.sub(r'\s+', '', to_text(value)).replace(',', '.')
+    return float(text) if text else 0.0
+
+
+def check_length(model, name, value):
+    max_length = model._meta.get_field(name).max_length
+    if len(value) > max_length:
+        raise ValueError(f'{name} is longer than {max_length} characters')
+    return value
+
+
+def parse_row(values, columns):
+    row = {key: value for key, value in zip(columns, values) if key}
+    uniq_code = check_length(AlboProductModel, 'uniq_code', to_text(row.pop('uniq_code', None)))
+    if not uniq_code:
+        raise ValueError('uniq_code is empty')
+
+    for name in PRODUCT_FIELDS:
+        if name not in row:
+            continue
+        if name in FLOAT_FIELDS:
+            try:
+                row[name] = to_float(row[name])
+            except ValueError:
+                raise ValueError(f'{name} is not a number: {row[name]!r}')
+        else:
+            row[name] = check_length(AlboProductModel, name, to_text(row[name]))
+    if 'category' in row:
+        row['category'] = check_length(CategoryProduct, 'name_category', to_text(row['category']))
+    if 'codes_1c' in row:
+        list_code = [code for code in CODES_SEPARATOR_RE.split(to_text(row['codes_1c'])) if code]
+        for code in list_code:
+            check_length(OneCCodeAlboModel, 'uniq_code_one_c', code)
+        if list_code:
+            check_length(UniqCodeModel, 'uniq_code', uniq_code)
+        row['codes_1c'] = list_code
+    return uniq_code, row
+
+
+def get_categories(set_name):
+    """Return {name: category}, creating the missing ones; names are not unique, the first one is used."""
+    categories = {}
+    for category in CategoryProduct.objects.filter(name_category__in=set_name).order_by('-pk'):
+        categories[category.name_category] = category
+    list_new = [CategoryProduct(name_category=name) for name in set_name - categories.keys()]
+    if list_new:
+        CategoryProduct.objects.bulk_create(list_new)
+        for category in CategoryProduct.objects.filter(name_category__in=[c.name_category for c in list_new]):
+            categories.setdefault(category.name_category, category)
+    return categories, len(list_new)
+
+
+def create_missing_mappings(model, pairs):
+    """Create the (map_code_id, uniq_code_one_c) pairs of model that do not exist yet."""
+    existing = set(model.objects.filter(map_code_id__in={map_code_id for map_code_id, _ in pairs})
+                   .values_list('map_code_id', 'uniq_code_one_c'))
+    list_new = [model(map_code_id=map_code_id, uniq_code_one_c=code) for map_code_id, code in pairs - existing]
+    model.objects.bulk_create(list_new)
+    return len(list_new)
+
+
+def write_batch(batch, columns):
+    """Upsert one batch {uniq_code: row} of products, categories and 1C codes in one transaction.
+
+    uniq_code is not unique in AlboProductModel, so rows are matched by a select and written
+    with bulk_update/bulk_create; every product with the code of a row is updated.
+    """
+    fields = [name for name in PRODUCT_FIELDS if name in columns]
+    if 'category' in columns:
+        fields.append('category_product')
+
+    counts = {'created': 0, 'updated': 0, 'categories': 0, 'mappings': 0}
+    with transaction.atomic():
+        categories, counts['categories'] = get_categories(
+            {row['category'] for row in batch.values() if row.get('category')})
+
+        products = {}
+        for product in AlboProductModel.objects.filter(uniq_code__in=batch):
+            products.setdefault(product.uniq_code, []).append(product)
+        list_create = []
+        list_update = []
+        for uniq_code, row in batch.items():
+            if uniq_code in products:
+                list_update.extend(products[uniq_code])
+                list_product = products[uniq_code]
+            else:
+                list_product = [AlboProductModel(uniq_code=uniq_code)]
+                list_create.extend(list_product)
+            for product in list_product:
+                for name in PRODUCT_FIELDS:
+                    if name in row:
+                        setattr(product, name, row[name])
+                if 'category' in row:
+                    product.category_product = categories.get(row['category'])
+
+        AlboProductModel.objects.bulk_create(list_create)
+        if list_update and fields:
+            AlboProductModel.objects.bulk_update(list_update, fields)
+        counts['created'] = len(list_create)
+        counts['updated'] = len(list_update)
+
+        codes = {uniq_code: row['codes_1c'] for uniq_code, row in batch.items() if row.get('codes_1c')}
+        if not codes:
+            return counts
+        # bulk_create does not return the ids on every backend, they are selected again
+        albo_pairs = {(pk, code) for uniq_code, pk in
+                      AlboProductModel.objects.filter(uniq_code__in=codes).values_list('uniq_code', 'pk')
+                      for code in codes[uniq_code]}
+        UniqCodeModel.objects.bulk_create([UniqCodeModel(uniq_code=uniq_code) for uniq_code in codes],
+                                          ignore_conflicts=True)
+        uniq_pairs = {(pk, code) for uniq_code, pk in
+                      UniqCodeModel.objects.filter(uniq_code__in=codes).values_list('uniq_code', 'pk')
+                      for code in codes[uniq_code]}
+        counts['mappings'] = create_missing_mappings(OneCCodeAlboModel, albo_pairs) + \
+            create_missing_mappings(OneCCodeModel, uniq_pairs)
+    return counts
+
+
+def import_catalog(file, filename, delimiter=';', batch_size=CATALOG_IMPORT_BATCH_SIZE):
+    """Import AlboProductModel rows with their categories and 1C codes from an XLSX or CSV file.
+
+    The first row names the columns: uniq_code and any of category, describe, url_describe,
+    url_image_albo, price_sample, size_field, codes_1c (or their verbose names). Columns that
+    are missing are left unchanged. Every batch_size rows are written in their own transaction,
+    a row that fails is reported in errors as (line, message) and the rest of the file goes on.
+    """
+    report = {'rows': 0, 'created': 0, 'updated': 0, 'categories': 0, 'mappings': 0, 'errors': []}
+    rows = iter_rows(file, filename, delimiter)
+    names = get_column_names()
+    try:
+        columns = [names.get(to_text(value).lower()) for value in next(rows, ())]
+    except CatalogFileError as error:
+        report['errors'].append((1, str(error)))
+        return report
+    if 'uniq_code' not in columns:
+        report['errors'].append((1, 'no uniq_code column in the header'))
+        return report
+
+    batch = {}
+    lines = {}
+    line = 1
+    try:
+        for line, values in enumerate(rows, start=2):
+            if not any(to_text(value) for value in values):
+                continue
+            report['rows'] += 1
+            try:
+                uniq_code, row = parse_row(values, columns)
+            except ValueError as error:
+                report['errors'].append((line, str(error)))
+                continue
+            # a code repeated in the file takes the values of its last row
+            batch[uniq_code] = row
+            lines[uniq_code] = line
+            if len(batch) >= batch_size:
+                write_with_report(batch, lines, columns, report)
+                batch, lines = {}, {}
+    except CatalogFileError as error:
+        # the rows read before are written, the rest of the file is reported as one error
+        report['errors'].append((line + 1, str(error)))
+    if batch:
+        write_with_report(batch, lines, columns, report)
+
+    # bulk writes send no signals
+    invalidate_code_index()
+    invalidate_catalog()
+    if report['categories']:
+        invalidate_visible_categories()
+    if report['created'] or report['mappings']:
+        # the import writes only the codes it has not written before, new products need all of them
+        ImportStateModel.forget_merged()
+    return report
+
+
+def write_with_report(batch, lines, columns, report):
+    try:
+        counts = write_batch(batch, columns)
+    except DatabaseError as error:
+        if len(batch) == 1:
+            report['errors'].append((lines[next(iter(batch))], str(error)))
+            return
+        # find the rows the database refuses, the others are written one by one
+        for uniq_code, row in batch.items():
+            write_with_report({uniq_code: row}, lines, columns, report)
+    else:
+        for key, value in counts.items():
+            report[key] += value
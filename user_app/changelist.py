@@ -0,0 +1,144 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.contrib.admin import AllValuesFieldListFilter
+from django.contrib.admin.views.main import ChangeList
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db.models import QuerySet
+
+from albo.metrics import CATALOG_CACHE_REQUESTS
+from user_app.caching import get_catalog_version, get_visible_category_ids
+from user_app.paginator import EstimatedCountPaginator
+
+
+class CachedDatesQuerySet(QuerySet):
+    """QuerySet of the date_hierarchy buckets whose aggregate and dates queries are cached.
+
+    The buckets scan the whole filtered table on every page load and change only when new
+    rows arrive, so they are kept for cache_timeout seconds per query.
+    """
+    cache_timeout = 60 * 5
+
+    def get_cache_key(self, method, *args, **kwargs):
+        try:
+            sql = str(self.query)
+        except EmptyResultSet:
+            sql = ''
+        digest = hashlib.md5(f'{sql}:{method}:{args!r}:{sorted(kwargs.items())!r}'.encode()).hexdigest()
+        return f'changelist-dates:{self.model._meta.label_lower}:{digest}'
+
+    def get_or_set(self, method, func, *args, **kwargs):
+        def evaluate():
+            result = func(*args, **kwargs)
+            return list(result) if isinstance(result, QuerySet) else result
+
+        return cache.get_or_set(self.get_cache_key(method, *args, **kwargs), evaluate, self.cache_timeout)
+
+    def aggregate(self, *args, **kwargs):
+        return self.get_or_set('aggregate', super().aggregate, *args, **kwargs)
+
+    def dates(self, *args, **kwargs):
+        return self.get_or_set('dates', super().dates, *args, **kwargs)
+
+    def datetimes(self, *args, **kwargs):
+        return self.get_or_set('datetimes', super().datetimes, *args, **kwargs)
+
+
+class CachedDatesChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        # the queryset is only read by the date_hierarchy tag from here on
+        if self.date_hierarchy:
+            self.queryset = CachedDatesQuerySet(self.model, self.queryset.query.chain(), self.queryset.db)
+
+
+class EstimatedCountAdminMixin:
+    """Opt-in for changelists of tables too large to count on every page load.
+
+    Uses planner estimates for the paginator, drops the second count of the unfiltered
+    table and caches the date_hierarchy buckets.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return CachedDatesChangeList
+
+
+def get_catalog_cache_key(name, *parts):
+    digest = hashlib.md5(json.dumps(parts, default=str).encode()).hexdigest()
+    return f'catalog-{name}:{get_catalog_version()}:{digest}'
+
+
+def get_cached_catalog(name, key):
+    """Return the cached value of key or None, counting the hit or miss of the name cache."""
+    data = cache.get(key)
+    CATALOG_CACHE_REQUESTS.labels(name, 'miss' if data is None else 'hit').inc()
+    return data
+
+
+class CachedAllValuesFieldListFilter(AllValuesFieldListFilter):
+    """AllValuesFieldListFilter whose distinct values are cached until the catalog changes."""
+
+    def choices(self, changelist):
+        try:
+            sql = str(self.lookup_choices.query)
+        except EmptyResultSet:
+            sql = ''
+        key = get_catalog_cache_key('filter', self.lookup_choices.model._meta.label_lower, sql)
+        lookup_choices = get_cached_catalog('filter', key)
+        if lookup_choices is None:
+            lookup_choices = list(self.lookup_choices)
+            cache.set(key, lookup_choices, settings.CATALOG_CACHE_TIMEOUT)
+        self.lookup_choices = lookup_choices
+        return super().choices(changelist)
+
+
+class CatalogChangeList(CachedDatesChangeList):
+    """ChangeList whose page of results is cached until the catalog changes.
+
+    The rendered page holds the CSRF token and the messages of the request, so the rows and
+    counts it is rendered from are cached instead, per site, discount, visible categories and
+    query string (page, ordering, filters, search).
+    """
+
+    def get_cache_key(self, request):
+        user = request.user
+        return get_catalog_cache_key(
+            'changelist', self.model_admin.admin_site.name, self.model._meta.label_lower,
+            getattr(user, 'discount', 0) or 0, get_visible_category_ids(user), self.page_num,
+            sorted(request.GET.lists()),
+        )
+
+    def get_results(self, request):
+        key = self.get_cache_key(request)
+        data = get_cached_catalog('changelist', key)
+        if data is None:
+            super().get_results(request)
+            cache.set(key, {
+                'result_count': self.result_count,
+                'full_result_count': self.full_result_count,
+                'result_list': list(self.result_list),
+            }, settings.CATALOG_CACHE_TIMEOUT)
+            return
+
+        # the attributes ChangeList.get_results sets, restored without a query
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        paginator.count = data['result_count']
+        self.result_count = data['result_count']
+        self.full_result_count = data['full_result_count']
+        self.result_list = data['result_list']
+        self.show_full_result_count = self.model_admin.show_full_result_count
+        self.show_admin_actions = not self.show_full_result_count or bool(self.full_result_count)
+        self.can_show_all = self.result_count <= self.list_max_show_all
+        self.multi_page = self.result_count > self.list_per_page
+        self.paginator = paginator
+
+
+class CatalogCacheAdminMixin:
+    """Opt-in for the catalog changelists, see CatalogChangeList and CachedAllValuesFieldListFilter."""
+
+    def get_changelist(self, request, **kwargs):
+        return CatalogChangeList
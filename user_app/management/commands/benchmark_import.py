@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+# the import caches its code index and takes its lock in the default cache, the benchmark
+# must not share them with the production workers
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class Command(BaseCommand):
+    help = ('Time every stage of task_export on synthetic 1C files served by a local FTP server. '
+            'Runs against a throwaway test database and needs pyftpdlib.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+        parser.add_argument('--codes', type=int, default=20_000, help='1C codes mapped to products')
+        parser.add_argument('--products', type=int, default=10_000)
+        parser.add_argument('--streaming', action='store_true', help='parse the file while it is downloaded')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        from user_app import caching
+
+        with override_settings(CACHES=BENCHMARK_CACHES):
+            caching._local_code_index.update(version=None, index=None)
+            try:
+                self.run_benchmark(options)
+            finally:
+                caching._local_code_index.update(version=None, index=None)
+
+    def run_benchmark(self, options):
+        try:
+            from pyftpdlib.authorizers import DummyAuthorizer
+            from pyftpdlib.handlers import FTPHandler
+            from pyftpdlib.log import config_logging
+            from pyftpdlib.servers import FTPServer
+        except ImportError:
+            raise CommandError('benchmark_import needs pyftpdlib, pip install pyftpdlib')
+
+        from albo.celery import app
+        from albo.ftp_pool import ftp_pool
+        from albo.tasks import task_export
+        from albo.timing import collect_stages
+        from user_app import models
+        from user_app.caching import invalidate_code_index
+
+        config_logging(level=logging.WARNING)
+        random.seed(options['seed'])
+        app.conf.task_always_eager = True
+        old_config = setup_databases(verbosity=0, interactive=False)
+
+        with tempfile.TemporaryDirectory() as directory:
+            authorizer = DummyAuthorizer()
+            authorizer.add_user('bench', 'bench', directory, perm='elradfmw')
+            handler = type('BenchFTPHandler', (FTPHandler,), {'authorizer': authorizer})
+            server = FTPServer(('127.0.0.1', 0), handler)
+            address = '127.0.0.1:bench:bench:%s' % server.socket.getsockname()[1]
+            thread = threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True)
+            thread.start()
+
+            try:
+                self.seed_mapping(models, options['codes'], options['products'])
+                invalidate_code_index()
+
+                list_result = []
+                file_time = datetime(2024, 1, 1)
+                for rows in options['rows']:
+                    file_time += timedelta(minutes=1)
+                    path = os.path.join(directory, f'stock_{file_time:%Y-%m-%dT%H:%M:%S}.csv')
+                    self.write_csv(path, rows)
+                    models.ImportStateModel.objects.all().delete()
+                    ftp_pool.clear()
+
+                    with collect_stages() as timings:
+                        start = time.perf_counter()
+                        task_export(import_ftp_address=address, streaming=options['streaming'],
+                                    filename_for_export=os.path.join(directory, 'export.txt'))
+                        total = time.perf_counter() - start
+
+                    list_result.append({
+                        'rows': rows,
+                        'file_bytes': os.path.getsize(path),
+                        'streaming': options['streaming'],
+                        'stages': {key: round(value, 6) for key, value in timings.items()},
+                        'total': round(total, 6),
+                        'rows_per_second': round(rows / total),
+                    })
+                    os.remove(path)
+                    self.stderr.write(f'{rows} rows - {total:.3f}s')
+            finally:
+                ftp_pool.clear()
+                server.close_all()
+                teardown_databases(old_config, verbosity=0)
+
+        data = json.dumps(list_result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f_obj:
+                f_obj.write(data)
+        else:
+            self.stdout.write(data)
+
+    @staticmethod
+    def seed_mapping(models, codes, products):
+        list_uniq_code = models.UniqCodeModel.objects.bulk_create(
+            models.UniqCodeModel(uniq_code=f'A{i:07d}') for i in range(products))
+        models.AlboProductModel.objects.bulk_create(
+            models.AlboProductModel(uniq_code=f'A{i:07d}', describe=f'product {i}') for i in range(products))
+        models.OneCCodeModel.objects.bulk_create(
+            models.OneCCodeModel(map_code=list_uniq_code[i % products], uniq_code_one_c=f'{i:09d}')
+            for i in range(codes))
+
+    @staticmethod
+    def write_csv(path, rows):
+        # 1C writes ';' separated rows with thousands grouped by spaces, "1 234"
+        with open(path, 'w', encoding='utf-8') as f_obj:
+            f_obj.write('Код;Количество\n')
+            for i in range(rows):
+                f_obj.write(f'{i:09d};{random.randint(0, 20000):,}\n'.replace(',', ' '))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from user_app.catalog_import import CATALOG_IMPORT_BATCH_SIZE, import_catalog
+
+
+class Command(BaseCommand):
+    help = ('Import AlboProductModel rows with their categories and 1C codes from an XLSX or CSV file. '
+            'Rows that fail are reported and the rest of the file is imported.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--delimiter', default=';', help='column delimiter of a CSV file')
+        parser.add_argument('--batch-size', type=int, default=CATALOG_IMPORT_BATCH_SIZE,
+                            help='rows written per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            f_obj = open(options['path'], 'rb')
+        except OSError as error:
+            raise CommandError(error)
+        with f_obj:
+            report = import_catalog(f_obj, options['path'], options['delimiter'], options['batch_size'])
+
+        for line, message in report['errors']:
+            self.stderr.write(f'line {line}: {message}')
+        self.stdout.write(
+            f"rows: {report['rows']}, created: {report['created']}, updated: {report['updated']}, "
+            f"categories: {report['categories']}, 1C codes: {report['mappings']}, errors: {len(report['errors'])}")
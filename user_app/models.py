@@ -3,7 +3,8 @@ import json
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django.db.models.signals import post_delete, post_save
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.conf import settings
 from django.dispatch import receiver
 from django.utils import timezone
 from django_celery_beat.models import PeriodicTask, CrontabSchedule
@@ -13,8 +14,6 @@ from django.utils.html import mark_safe
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.utils.html import format_html
-import albo.settings
-from django.contrib.admin.models import LogEntry, ADDITION, CHANGE
 
 
 class UserManager(BaseUserManager):
@@ -87,7 +86,7 @@ class MyUser(AbstractUser):
 
 
 class CategoryProduct(models.Model):
-    name_category = models.CharField(max_length=120, default='', verbose_name='Категории товара')
+    name_category = models.CharField(max_length=120, default='', verbose_name='Категории товара', db_index=True)
 
     class Meta:
         verbose_name = "Категория"
@@ -104,7 +103,7 @@ class CategoryProductExclude(models.Model):
 
 class AlboProductModel(models.Model):
     category_product = models.ForeignKey(CategoryProduct, on_delete=models.CASCADE, blank=True, null=True)
-    uniq_code = models.CharField(max_length=255, default='', verbose_name='Код товара')
+    uniq_code = models.CharField(max_length=255, default='', verbose_name='Код товара', db_index=True)
     describe = models.CharField(max_length=255, default='', verbose_name='Описание товара')
     url_describe = models.URLField(verbose_name="Ссылка на описание товара на сайте", max_length=255, blank=True,
                                    null=True)
@@ -134,12 +133,12 @@ class AlboProductModel(models.Model):
 
 class OneCCodeAlboModel(models.Model):
     map_code = models.ForeignKey(AlboProductModel, on_delete=models.CASCADE)
-    uniq_code_one_c = models.CharField(max_length=120, verbose_name='Code 1C')
+    uniq_code_one_c = models.CharField(max_length=120, verbose_name='Code 1C', db_index=True)
 
 
 class ProductModel(models.Model):
     category_product = models.ForeignKey(CategoryProduct, on_delete=models.CASCADE, blank=True, null=True)
-    uniq_code = models.CharField(max_length=255, default='', verbose_name='Код товара')
+    uniq_code = models.CharField(max_length=255, default='', verbose_name='Код товара', db_index=True)
     describe = models.CharField(max_length=255, default='', verbose_name='Описание товара')
     url_describe = models.URLField(verbose_name="Ссылка на описание товара на сайте", default='', max_length=100)
     url_image_albo = models.URLField(verbose_name="Ссылка на фото товара на сайте", default='', max_length=100)
@@ -173,7 +172,7 @@ class UniqCodeModel(models.Model):
 
 class OneCCodeModel(models.Model):
     map_code = models.ForeignKey(UniqCodeModel, on_delete=models.CASCADE)
-    uniq_code_one_c = models.CharField(max_length=120, verbose_name='Code 1C')
+    uniq_code_one_c = models.CharField(max_length=120, verbose_name='Code 1C', db_index=True)
 
 
 class PeriodicTimeModel(models.Model):
@@ -190,14 +189,45 @@ class PeriodicTimeModel(models.Model):
         return f'{self.get_val_periodic_minute}'
 
 
+class ImportStateModel(models.Model):
+    # the state of the quantities summed over all sources and written to the products
+    MERGED_SOURCE = '*'
+
+    source = models.CharField(max_length=255, unique=True, verbose_name='Источник импорта')
+    filename = models.CharField(max_length=255, default='')
+    file_time = models.DateTimeField(blank=True, null=True)
+    size = models.BigIntegerField(blank=True, null=True)
+    modify = models.CharField(max_length=20, default='', blank=True)
+    snapshot = models.JSONField(default=dict, blank=True)
+    last_import = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.source} - {self.filename}'
+
+    def is_same_file(self, marker):
+        return (self.filename, self.size, self.modify) == (marker['filename'], marker['size'], marker['modify'])
+
+    def get_changed(self, data):
+        snapshot = self.snapshot
+        return {key: value for key, value in data.items() if snapshot.get(key) != value}
+
+    @classmethod
+    def forget_merged(cls):
+        """Make the next import write every code, the products added since the last one included."""
+        cls.objects.filter(source=cls.MERGED_SOURCE).update(snapshot={})
+
+
 class UserActivityTrack(models.Model):
     user = models.ForeignKey(MyUser, on_delete=models.CASCADE)
     session_key = models.CharField(max_length=40, db_index=True)
-    login = models.DateTimeField(auto_now_add=True)
+    login = models.DateTimeField(default=timezone.now)
     logout = models.DateTimeField(null=True, default=None)
     ip = models.CharField(max_length=255)
     user_agent = models.CharField(max_length=255)
 
+    class Meta:
+        indexes = [models.Index(fields=['user', 'session_key'], name='activity_user_session_idx')]
+
     def __str__(self):
         name = self.user.get_full_name or 'No Name'
         return f'{name}'
@@ -216,12 +246,12 @@ def function_create_beat(time_beat, task, name_task, **kwargs):
 @receiver(post_save, sender=PeriodicTimeModel)
 def create_track_signal(sender, instance, **kwargs):
     beat_time = str(instance.get_val_periodic_minute)
-    IMPORT_FTP_ADDRESS = albo.settings.IMPORT_FTP_ADDRESS
-    EXPORT_FTP_ADDRESS = albo.settings.EXPORT_FTP_ADDRESS
-    FILE_NAME_FOR_EXPORT = albo.settings.FILE_NAME_FOR_EXPORT
+    IMPORT_FTP_ADDRESSES = settings.IMPORT_FTP_ADDRESSES
+    EXPORT_FTP_ADDRESS = settings.EXPORT_FTP_ADDRESS
+    FILE_NAME_FOR_EXPORT = settings.FILE_NAME_FOR_EXPORT
     kwargs = {}
     kwargs.update({
-        'import_ftp_address': IMPORT_FTP_ADDRESS,
+        'import_ftp_addresses': IMPORT_FTP_ADDRESSES,
         'export_ftp_address': EXPORT_FTP_ADDRESS,
         'filename_for_export': FILE_NAME_FOR_EXPORT,
     })
@@ -234,19 +264,58 @@ def delete_period_task(sender, instance, **kwargs):
     CrontabSchedule.objects.all().delete()
 
 
+@receiver(post_save, sender=OneCCodeModel)
+@receiver(post_delete, sender=OneCCodeModel)
+@receiver(post_save, sender=UniqCodeModel)
+@receiver(post_delete, sender=UniqCodeModel)
+def invalidate_code_index_signal(sender, instance, **kwargs):
+    from user_app.caching import invalidate_code_index
+    invalidate_code_index()
+
+
+@receiver(post_save, sender=CategoryProductExclude)
+@receiver(post_delete, sender=CategoryProductExclude)
+@receiver(post_save, sender=CategoryProduct)
+@receiver(post_delete, sender=CategoryProduct)
+def invalidate_visible_categories_signal(sender, instance, **kwargs):
+    from user_app.caching import invalidate_visible_categories
+    invalidate_visible_categories()
+
+
+@receiver(post_save, sender=AlboProductModel)
+@receiver(post_delete, sender=AlboProductModel)
+@receiver(post_save, sender=ProductModel)
+@receiver(post_delete, sender=ProductModel)
+@receiver(post_save, sender=CategoryProduct)
+@receiver(post_delete, sender=CategoryProduct)
+def invalidate_catalog_signal(sender, instance, **kwargs):
+    from user_app.caching import invalidate_catalog
+    invalidate_catalog()
+
+
+@receiver(pre_save, sender=AlboProductModel)
+def forget_merged_import_signal(sender, instance, **kwargs):
+    # a new product, or one moved to another code, keeps quantity 0 until its code is written again
+    if instance.pk is None or not sender.objects.filter(pk=instance.pk, uniq_code=instance.uniq_code).exists():
+        ImportStateModel.forget_merged()
+
+
+@receiver(post_save, sender=OneCCodeAlboModel)
+@receiver(post_delete, sender=OneCCodeAlboModel)
+def forget_merged_import_mapping_signal(sender, instance, **kwargs):
+    ImportStateModel.forget_merged()
+
+
 @receiver(user_logged_in)
 def post_login(sender, user, request, **kwargs):
     messages.add_message(request, messages.INFO, user.get_full_name + ' Hello!')
 
     # locationInfo = get_location_data__from_ip(ip)
-    UserActivityTrack.objects.create(
-        user=user,
-        session_key=request.session.session_key,
-        ip=request.META.get('REMOTE_ADDR'),
-        user_agent=request.META.get('HTTP_USER_AGENT'),
-    )
+    from user_app.activity import activity_buffer
+    activity_buffer.login(user, request)
 
 
 @receiver(user_logged_out)
 def post_logged_out(sender, user, request, **kwargs):
-    UserActivityTrack.objects.filter(user=user, session_key=request.session.session_key).update(logout=timezone.now())
+    from user_app.activity import activity_buffer
+    activity_buffer.logout(user, request)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import operator
+from functools import reduce
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from django.db.models import F, Q
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import OrderBy
+
+
+class KeysetPaginator(Paginator):
+    """Paginator of admin changelists that seeks to the next page instead of using OFFSET.
+
+    The ordering key of the last row of every served page is cached as the start of the next
+    page, so walking through a changelist costs the same on page 1000 as on page 2. A page
+    whose start is not known yet, or an ordering that can not be expressed as a keyset
+    (a nullable column without an explicit NULLS FIRST/LAST, an expression), uses OFFSET.
+    """
+    cache_timeout = 60 * 10
+
+    def page(self, number):
+        number = self.validate_number(number)
+        keyset = self.get_keyset()
+        after = cache.get(self.get_cache_key(number)) if keyset and number > 1 else None
+
+        if after is not None:
+            object_list = list(self.object_list.filter(self.get_after_q(keyset, after))[:self.per_page])
+        else:
+            bottom = (number - 1) * self.per_page
+            object_list = list(self.object_list[bottom:bottom + self.per_page])
+
+        if keyset and object_list and number < self.num_pages:
+            cache.set(self.get_cache_key(number + 1), self.get_key(keyset, object_list[-1]), self.cache_timeout)
+        return self._get_page(object_list, number, self)
+
+    def get_cache_key(self, number):
+        try:
+            sql = str(self.object_list.query)
+        except EmptyResultSet:
+            sql = ''
+        digest = hashlib.md5(f'{sql}:{self.per_page}'.encode()).hexdigest()
+        return f'keyset-page:{digest}:{number}'
+
+    def get_keyset(self):
+        """Return [(lookup, descending, nulls), ...] of the queryset ordering, or None."""
+        query = self.object_list.query
+        opts = self.object_list.model._meta
+        keyset = []
+        for item in query.order_by:
+            if isinstance(item, str) and item != '?':
+                name, descending, nulls = item.lstrip('-'), item.startswith('-'), None
+            elif isinstance(item, OrderBy) and isinstance(item.expression, F):
+                name, descending = item.expression.name, item.descending
+                nulls = 'last' if item.nulls_last else 'first' if item.nulls_first else None
+            else:
+                return None
+            if name == 'pk':
+                name = opts.pk.name
+
+            nullable = False if name in query.annotations else self.is_nullable(opts, name)
+            if nullable is None or nullable and nulls is None:
+                return None
+            keyset.append((name, descending, nulls))
+        return keyset or None
+
+    @staticmethod
+    def is_nullable(opts, name):
+        nullable = False
+        for part in name.split(LOOKUP_SEP):
+            try:
+                field = opts.get_field(part)
+            except FieldDoesNotExist:
+                return None
+            nullable = nullable or field.null
+            if field.is_relation:
+                opts = field.related_model._meta
+        return nullable
+
+    @staticmethod
+    def get_key(keyset, obj):
+        key = []
+        for name, _, _ in keyset:
+            value = obj
+            for part in name.split(LOOKUP_SEP):
+                value = getattr(value, part, None)
+                if value is None:
+                    break
+            if hasattr(value, '_meta'):
+                value = value.pk
+            key.append(value)
+        return key
+
+    @staticmethod
+    def get_after_q(keyset, key):
+        list_q = []
+        equal = Q()
+        for (name, descending, nulls), value in zip(keyset, key):
+            if value is None:
+                # only non NULL rows can follow a NULL, and only when NULLs come first
+                if nulls == 'first':
+                    list_q.append(equal & Q(**{f'{name}__isnull': False}))
+                equal &= Q(**{f'{name}__isnull': True})
+            else:
+                step = Q(**{f'{name}__{"lt" if descending else "gt"}': value})
+                if nulls == 'last':
+                    step |= Q(**{f'{name}__isnull': True})
+                list_q.append(equal & step)
+                equal &= Q(**{name: value})
+        return reduce(operator.or_, list_q) if list_q else Q(pk__in=[])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that takes the row count from the PostgreSQL planner on large tables.
+
+    An unfiltered changelist reads pg_class.reltuples, a filtered one the row estimate of
+    EXPLAIN. Only above estimate_threshold rows is the estimate used, smaller results and
+    other backends are counted exactly, so short lists keep an exact number of pages.
+    """
+    estimate_threshold = 100_000
+
+    @cached_property
+    def count(self):
+        estimate = self.get_estimate()
+        if estimate is not None and estimate > self.estimate_threshold:
+            return estimate
+        return super().count
+
+    def get_estimate(self):
+        if not hasattr(self.object_list, 'query') or connections[self.object_list.db].vendor != 'postgresql':
+            return None
+        queryset = self.object_list.order_by()
+        query = queryset.query
+        try:
+            sql, params = query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+
+        connection = connections[queryset.db]
+        with connection.cursor() as cursor:
+            if not query.where and not query.distinct and not query.combinator:
+                cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                               [connection.ops.quote_name(queryset.model._meta.db_table)])
+                row = cursor.fetchone()
+                # -1 until the table is analyzed for the first time
+                if row and row[0] >= 0:
+                    return row[0]
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedKeysetPaginator(EstimatedCountPaginator, KeysetPaginator):
+    """KeysetPaginator with the row count of EstimatedCountPaginator."""
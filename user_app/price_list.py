@@ -0,0 +1,107 @@
+import csv
+import hashlib
+import json
+import os
+from decimal import Decimal
+from pathlib import Path
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import DecimalField, F, Value
+from django.db.models.functions import Cast, Round
+
+from user_app.caching import filter_category_ids, get_catalog_version, get_visible_category_ids
+from user_app.models import AlboProductModel, ProductModel
+
+PRICE_LIST_TYPES = ('xlsx', 'csv')
+PRICE_LIST_HEADER = ('Каталог', 'Категория', 'Код товара', 'Описание товара', 'Цена обычная', 'Цена со скидкой')
+PRICE_LIST_CHUNK_SIZE = 2000
+# a build lost with its worker is started again after this many seconds
+PRICE_LIST_PENDING_TIMEOUT = 60 * 10
+
+
+def get_customer_price(discount):
+    """Expression of price_sample minus the discount in %, computed by the database."""
+    price = Cast(F('price_sample') * Value(1 - (discount or 0) / 100), DecimalField(max_digits=16, decimal_places=4))
+    return Round(price, 2, output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def round_price(value):
+    """Customer price to two places, SQLite does not round the computed value of get_customer_price."""
+    if value is None:
+        return None
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+
+def get_fingerprint(discount, list_category_id, _type):
+    """Customers with the same discount and visible categories share one price list."""
+    return hashlib.md5(json.dumps([discount or 0, list_category_id, _type]).encode()).hexdigest()
+
+
+def get_price_list(user, _type):
+    """Return the path of the ready price list of the user, or None and start building it.
+
+    A price list is ready until the catalog changes, the new one replaces its file when built.
+    """
+    discount = user.discount or 0
+    list_category_id = get_visible_category_ids(user)
+    fingerprint = get_fingerprint(discount, list_category_id, _type)
+    version = get_catalog_version()
+
+    path = cache.get(f'price-list:{version}:{fingerprint}')
+    if path and os.path.exists(path):
+        return path
+    if cache.add(f'price-list-pending:{version}:{fingerprint}', True, PRICE_LIST_PENDING_TIMEOUT):
+        from albo.tasks import task_price_list
+        task_price_list.delay(discount, list_category_id, _type, version)
+    return None
+
+
+def iter_price_list_rows(discount, list_category_id):
+    for model in (AlboProductModel, ProductModel):
+        queryset = filter_category_ids(model.objects.all(), list_category_id)
+        queryset = queryset.annotate(price_customer=get_customer_price(discount)).order_by(
+            F('category_product__name_category').asc(nulls_last=True), 'uniq_code', 'pk')
+        for row in queryset.values_list('category_product__name_category', 'uniq_code', 'describe', 'price_sample',
+                                        'price_customer').iterator(chunk_size=PRICE_LIST_CHUNK_SIZE):
+            yield (str(model._meta.verbose_name), *row[:-1], round_price(row[-1]))
+
+
+def write_price_list(filename, rows, _type):
+    if _type == 'xlsx':
+        from openpyxl import Workbook
+
+        # write-only rows go straight to the zip stream, memory does not grow with the catalog
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet('Прайс-лист')
+        sheet.append(PRICE_LIST_HEADER)
+        for row in rows:
+            sheet.append(row)
+        workbook.save(filename)
+    else:
+        with open(filename, 'w', encoding='utf-8', newline='') as f_obj:
+            writer = csv.writer(f_obj, delimiter=';')
+            writer.writerow(PRICE_LIST_HEADER)
+            writer.writerows(rows)
+
+
+def build_price_list(discount, list_category_id, _type, version=None):
+    """Write the price list and make it the ready one of the catalog version it was requested for."""
+    fingerprint = get_fingerprint(discount, list_category_id, _type)
+    version = version or get_catalog_version()
+    root = Path(settings.PRICE_LIST_ROOT)
+    root.mkdir(parents=True, exist_ok=True)
+    # one file per fingerprint, a new catalog version replaces it
+    path = root / f'{fingerprint}.{_type}'
+    temp_path = root / f'{fingerprint}.{uuid4().hex}.tmp'
+    try:
+        write_price_list(temp_path, iter_price_list_rows(discount, list_category_id), _type)
+        # a download of the previous file keeps reading it until it is done
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+        cache.delete(f'price-list-pending:{version}:{fingerprint}')
+    cache.set(f'price-list:{version}:{fingerprint}', str(path), settings.PRICE_LIST_TIMEOUT)
+    return str(path)
@@ -1,3 +1,1051 @@
-from django.test import TestCase
+import ftplib
+import gzip
+import hashlib
+import importlib.util
+import io
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import pandas as pd
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F, Min
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from albo import parsers, tasks
+from albo.celery import app
+from albo.ftp_pool import ftp_pool
+from albo.locks import CacheLock
+from albo.tasks import RowReader
+from albo.timing import collect_stages
+from user_app.activity import ActivityBuffer, write_events
+from user_app.caching import get_code_index, invalidate_catalog
+from user_app.catalog_import import import_catalog
+from user_app.changelist import CachedDatesQuerySet
+from user_app.paginator import EstimatedCountPaginator, KeysetPaginator
+from user_app.price_list import build_price_list, get_price_list, iter_price_list_rows
+from user_app.models import AlboProductModel, CategoryProduct, CategoryProductExclude, ImportStateModel, MyUser, OneCCodeAlboModel, \
+    OneCCodeModel, ProductModel, UniqCodeModel, UserActivityTrack
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ACTIVITY_FLUSH_SIZE=1)
+class QueryBudgetTest(TestCase):
+    """Query counts and plans of the import and the admin changelists on a catalog of production size.
+
+    A missing index or a query per row shows up here as a failed budget.
+    """
+    products = 100_000
+    sites = {
+        'admin': ('alboproductmodel', 'productmodel', 'uniqcodemodel', 'categoryproduct'),
+        'general-admin': ('alboproductmodel', 'productmodel', 'uniqcodemodel', 'categoryproduct'),
+        'manager-admin': ('alboproductmodel', 'productmodel', 'uniqcodemodel', 'categoryproduct'),
+        'customer-admin': ('alboproductmodel', 'productmodel', 'categoryproduct'),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        list_category = CategoryProduct.objects.bulk_create(
+            CategoryProduct(name_category=f'category {i}') for i in range(50))
+        AlboProductModel.objects.bulk_create(
+            (AlboProductModel(uniq_code=f'A{i:07d}', category_product=list_category[i % 50], size_field=i % 7)
+             for i in range(cls.products)), batch_size=5000)
+        ProductModel.objects.bulk_create(
+            (ProductModel(uniq_code=f'A{i:07d}', category_product=list_category[i % 50])
+             for i in range(cls.products)), batch_size=5000)
+        list_uniq_code = UniqCodeModel.objects.bulk_create(
+            (UniqCodeModel(uniq_code=f'A{i:07d}') for i in range(cls.products)), batch_size=5000)
+        OneCCodeModel.objects.bulk_create(
+            (OneCCodeModel(map_code=uniq_code, uniq_code_one_c=f'{i:09d}') for i, uniq_code in
+             enumerate(list_uniq_code)), batch_size=5000)
+
+    def setUp(self):
+        cache.clear()
+
+    def get_plan(self, sql, params=()):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # the planner may prefer a scan of a small table even with the index in place
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+            return '\n'.join(' '.join(map(str, row)) for row in cursor.fetchall())
+
+    def get_index_name(self, model, field):
+        column = model._meta.get_field(field).column
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        names = [name for name, constraint in constraints.items()
+                 if constraint['index'] and not constraint['primary_key'] and constraint['columns'] == [column]]
+        self.assertEqual(len(names), 1, f'{model._meta.db_table}.{column}: {names}')
+        return names[0]
+
+    def assertPlanUsesIndex(self, plan, index_name):
+        # a full scan of the index, or of the table, would not be a search on the lookup column
+        if connection.vendor == 'postgresql':
+            pattern = rf'(Index Scan using|Index Only Scan using|Bitmap Index Scan on) {re.escape(index_name)}\b'
+        else:
+            pattern = rf'\bSEARCH \S+ USING (COVERING )?INDEX {re.escape(index_name)} \('
+        self.assertRegex(plan, pattern)
+
+    def assertIndexUsed(self, queryset, index_name):
+        self.assertPlanUsesIndex(self.get_plan(*queryset.query.sql_with_params()), index_name)
+
+    def login(self, site_name):
+        permissions = {'admin': '', 'general-admin': 'is_admin_general', 'manager-admin': 'is_admin_manager',
+                       'customer-admin': 'is_admin_customer'}
+        user = MyUser.objects.create_superuser(email=f'{site_name}@example.com', password='password')
+        user.resolution_value = permissions[site_name]
+        user.save()
+        self.client = self.client_class()
+        response = self.client.post(f'/{site_name}/login/', {'username': user.email, 'password': 'password'},
+                                    HTTP_USER_AGENT='test')
+        self.assertEqual(response.status_code, 302)
+
+    def test_lookup_columns_are_indexed(self):
+        for queryset, field in (
+                (AlboProductModel.objects.filter(uniq_code='A0000001'), 'uniq_code'),
+                (ProductModel.objects.filter(uniq_code='A0000001'), 'uniq_code'),
+                (OneCCodeModel.objects.filter(uniq_code_one_c='000000001'), 'uniq_code_one_c'),
+                (OneCCodeAlboModel.objects.filter(uniq_code_one_c='000000001'), 'uniq_code_one_c'),
+                (CategoryProduct.objects.filter(name_category='category 1'), 'name_category')):
+            with self.subTest(model=queryset.model.__name__):
+                self.assertIndexUsed(queryset, self.get_index_name(queryset.model, field))
+        # the session_key index alone would also serve this lookup
+        self.assertIndexUsed(UserActivityTrack.objects.filter(user_id=1, session_key='key'),
+                             'activity_user_session_idx')
+
+    def test_import_update_uses_index(self):
+        plan = self.get_plan('UPDATE "user_app_alboproductmodel" SET "quantity" = %s WHERE "uniq_code" = %s',
+                             (1, 'A0000001'))
+        self.assertPlanUsesIndex(plan, self.get_index_name(AlboProductModel, 'uniq_code'))
+
+    def test_import_queries(self):
+        with self.assertNumQueries(1):
+            get_code_index()
+
+        df = pd.DataFrame({'code': [f'{i:09d}' for i in range(0, self.products * 2, 2)],
+                           'quantity': ['1 234'] * self.products})
+        with self.assertNumQueries(0):
+            aggregator = tasks.QuantityAggregator()
+            aggregator.add(df)
+        self.assertEqual(len(aggregator.result), self.products // 2)
+
+        results = [{'source': 'test', 'changed': True, 'data': aggregator.result,
+                    'marker': {'filename': 'stock_2024-01-01T00:00:00.csv', 'size': 1, 'modify': ''}}]
+        with tempfile.NamedTemporaryFile() as f_obj, CaptureQueriesContext(connection) as context:
+            tasks.task_merge_sources(results, filename_for_export=f_obj.name)
+        # one statement per write batch on top of a fixed number of state lookups and saves
+        batches = -(-len(aggregator.result) // settings.IMPORT_WRITE_BATCH_SIZE)
+        self.assertLessEqual(len(context), batches + 15)
+        self.assertEqual(AlboProductModel.objects.filter(quantity=1234).count(), self.products // 2)
+
+    def test_changelist_queries(self):
+        for site_name, list_model in self.sites.items():
+            self.login(site_name)
+            for model_name in list_model:
+                with self.subTest(site=site_name, model=model_name):
+                    url = f'/{site_name}/user_app/{model_name}/'
+                    self.client.get(url)
+                    # the budget of a page built from the database, not of a cached one
+                    invalidate_catalog()
+                    with CaptureQueriesContext(connection) as first_page:
+                        self.assertEqual(self.client.get(url).status_code, 200)
+                    invalidate_catalog()
+                    with CaptureQueriesContext(connection) as next_page:
+                        self.assertEqual(self.client.get(url, {'p': 3}).status_code, 200)
+                    self.assertLessEqual(len(first_page), 15)
+                    self.assertEqual(len(first_page), len(next_page))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ParseEngineTest(TestCase):
+    """Every parse engine gives read_csv the same import result."""
+
+    @classmethod
+    def setUpTestData(cls):
+        mapping = {'P1': ['001', '002'], 'P2': ['003'], 'P3': ['004'], 'P4': ['002']}
+        for uniq_code, list_code in mapping.items():
+            uniq_code = UniqCodeModel.objects.create(uniq_code=uniq_code)
+            OneCCodeModel.objects.bulk_create(OneCCodeModel(map_code=uniq_code, uniq_code_one_c=code)
+                                              for code in list_code)
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.file = os.path.join(self.directory, 'stock.csv')
+        rows = ['Код;Количество;Склад', '001;1 234;a', '002;5;a', '003;7;b', '"004";0;b', '999;3;b', '',
+                '001;10;c', '003;2 000;c']
+        rows += [f'{i:03d};{i};d' for i in range(100, 600)] + ['002;8;d']
+        with open(self.file, 'w', encoding='utf-8') as f_obj:
+            f_obj.write('\n'.join(rows) + '\n')
+
+    def read(self, engine):
+        file = shutil.copy(self.file, os.path.join(self.directory, engine))
+        result = tasks.read_csv(file, engine)
+        self.assertFalse(os.path.exists(file))
+        return result
+
+    def test_engines_agree(self):
+        expected = {'P1': 18, 'P2': 2000, 'P3': 0, 'P4': 8}
+        for engine in ('csv', 'pandas'):
+            with self.subTest(engine=engine), collect_stages() as timings:
+                self.assertEqual(self.read(engine), expected)
+                self.assertLessEqual({'parse', 'map', 'aggregate'}, set(timings))
+
+    @skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_pyarrow_agrees(self):
+        self.assertEqual(self.read('pyarrow'), self.read('csv'))
+
+    @override_settings(IMPORT_PARSE_ENGINE='auto', IMPORT_PARSE_CSV_MAX_BYTES=100,
+                       IMPORT_PARSE_PYARROW_MIN_BYTES=1000)
+    def test_engine_by_size(self):
+        self.assertEqual(parsers.choose_engine(99), 'csv')
+        self.assertEqual(parsers.choose_engine(100), 'pandas')
+        large = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'pandas'
+        self.assertEqual(parsers.choose_engine(1000), large)
+
+
+class StartupImportTest(SimpleTestCase):
+    """Starting the web and worker processes imports no heavy dependency and stays in budget."""
+
+    HEAVY_MODULES = {'numpy', 'openpyxl', 'pandas', 'pyarrow'}
+    # cumulative microseconds of the top-level imports, generous for slow CI machines
+    BUDGET = 3_000_000
+    COMMANDS = {
+        'check': 'import django; django.setup(); from django.core.management import call_command; '
+                 'call_command("check", verbosity=0)',
+        'wsgi': 'import albo.wsgi',
+        'asgi': 'import albo.asgi',
+        'celery': 'from albo.celery import app; app.loader.import_default_modules()',
+    }
+    IMPORT_TIME_RE = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)$')
+
+    def import_time(self, command):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='albo.settings', SECRET_KEY=settings.SECRET_KEY)
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', command], env=env,
+                                cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=120)
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        modules = set()
+        total = 0
+        for line in result.stderr.splitlines():
+            match = self.IMPORT_TIME_RE.match(line)
+            if not match:
+                continue
+            cumulative, indent, name = match.groups()
+            modules.add(name.split('.')[0])
+            if len(indent) == 1:
+                total += int(cumulative)
+        return modules, total
+
+    def test_startup_imports(self):
+        for name, command in self.COMMANDS.items():
+            with self.subTest(name):
+                modules, total = self.import_time(command)
+                self.assertFalse(modules & self.HEAVY_MODULES)
+                self.assertLess(total, self.BUDGET)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ACTIVITY_FLUSH_SIZE=1)
+class CatalogCacheTest(TestCase):
+    """Catalog changelists are served from the cache until an import or a product save."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = CategoryProduct.objects.create(name_category='category')
+        AlboProductModel.objects.bulk_create(
+            AlboProductModel(uniq_code=f'A{i:03d}', category_product=category, price_sample=100) for i in range(150))
+        OneCCodeModel.objects.create(map_code=UniqCodeModel.objects.create(uniq_code='A000'), uniq_code_one_c='001')
+        cls.user = MyUser.objects.create_superuser(email='customer@example.com', password='password')
+        cls.user.resolution_value = 'is_admin_customer'
+        cls.user.discount = 10
+        cls.user.save()
+
+    def setUp(self):
+        cache.clear()
+        response = self.client.post('/customer-admin/login/', {'username': self.user.email, 'password': 'password'},
+                                    HTTP_USER_AGENT='test')
+        self.assertEqual(response.status_code, 302)
+        self.url = '/customer-admin/user_app/alboproductmodel/'
+
+    def get(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        table = AlboProductModel._meta.db_table
+        return response, [query['sql'] for query in context if table in query['sql']]
+
+    def get_requests(self, result):
+        return REGISTRY.get_sample_value('albo_catalog_cache_requests_total',
+                                         {'cache': 'changelist', 'result': result}) or 0
+
+    def test_hit_until_product_save(self):
+        _, queries = self.get()
+        self.assertTrue(queries)
+        hits = self.get_requests('hit')
+        response, queries = self.get()
+        self.assertEqual(queries, [])
+        self.assertEqual(self.get_requests('hit'), hits + 1)
+        self.assertContains(response, 'field-price_uniq">90')
+
+        product = AlboProductModel.objects.get(uniq_code='A000')
+        product.describe = 'changed'
+        product.save()
+        response, queries = self.get()
+        self.assertTrue(queries)
+        self.assertContains(response, 'changed')
+
+    def test_key_parts(self):
+        self.get()
+        _, queries = self.get(p=2)
+        self.assertTrue(queries)
+        _, queries = self.get(uniq_code='A001')
+        self.assertTrue(queries)
+        MyUser.objects.filter(pk=self.user.pk).update(discount=20)
+        response, queries = self.get()
+        self.assertTrue(queries)
+        self.assertContains(response, 'field-price_uniq">80')
+
+    def test_import_invalidates(self):
+        self.get()
+        results = [{'source': 'test', 'changed': True, 'data': {'A000': 5},
+                    'marker': {'filename': 'stock_2024-01-01T00:00:00.csv', 'size': 1, 'modify': ''}}]
+        with tempfile.NamedTemporaryFile() as f_obj:
+            tasks.task_merge_sources(results, filename_for_export=f_obj.name)
+        _, queries = self.get()
+        self.assertTrue(queries)
+
+
+@override_settings(ACTIVITY_FLUSH_SIZE=100, ACTIVITY_FLUSH_INTERVAL=3600)
+class ActivityBufferTest(TestCase):
+    """Login/logout events are written in batches and a bad event costs only itself."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = MyUser.objects.create_superuser(email='activity@example.com', password='password')
+
+    def login_event(self, session_key, user_agent='test'):
+        return 'login', self.user.pk, session_key, timezone.now(), '127.0.0.1', user_agent
+
+    def logout_event(self, session_key):
+        return 'logout', self.user.pk, session_key, timezone.now()
+
+    def test_write_events(self):
+        write_events([self.login_event('a')])
+        write_events([self.login_event('b'), self.logout_event('b'), self.logout_event('a')])
+        tracks = {track.session_key: track for track in UserActivityTrack.objects.all()}
+        self.assertEqual(set(tracks), {'a', 'b'})
+        self.assertIsNotNone(tracks['a'].logout)
+        self.assertIsNotNone(tracks['b'].logout)
+
+    def test_bad_event_is_dropped(self):
+        buffer = ActivityBuffer()
+        buffer.put(self.login_event('a'))
+        # NOT NULL user_agent fails the batch
+        buffer.put(self.login_event('b', user_agent=None))
+        buffer.put(self.login_event('c'))
+        with self.assertLogs('user_app.activity', 'ERROR'):
+            buffer.flush()
+        self.assertEqual(set(UserActivityTrack.objects.values_list('session_key', flat=True)), {'a', 'c'})
+
+        buffer.put(self.logout_event('a'))
+        buffer.flush()
+        self.assertIsNotNone(UserActivityTrack.objects.get(session_key='a').logout)
+
+    def test_buffer_is_bounded(self):
+        buffer = ActivityBuffer(max_events=2)
+        with self.assertLogs('user_app.activity', 'WARNING'):
+            for session_key in 'abc':
+                buffer.put(self.login_event(session_key))
+        buffer.flush()
+        self.assertEqual(set(UserActivityTrack.objects.values_list('session_key', flat=True)), {'b', 'c'})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MergeSourcesTest(TestCase):
+    """The quantities are committed before the export, the import state only after it."""
+
+    @classmethod
+    def setUpTestData(cls):
+        AlboProductModel.objects.create(uniq_code='A000')
+
+    def setUp(self):
+        cache.clear()
+        self.results = [{'source': 'test', 'changed': True, 'data': {'A000': 5},
+                         'marker': {'filename': 'stock_2024-01-01T00:00:00.csv', 'size': 1, 'modify': ''}}]
+
+    def test_failed_export_is_retried(self):
+        with self.assertRaises(FileNotFoundError):
+            tasks.merge_sources(self.results, '', '/nonexistent/export.txt')
+        self.assertEqual(AlboProductModel.objects.get().quantity, 5)
+        self.assertFalse(ImportStateModel.objects.exists())
+
+        with tempfile.NamedTemporaryFile() as f_obj:
+            tasks.merge_sources(self.results, '', f_obj.name)
+            self.assertEqual(f_obj.read(), b'A000;5\r\n')
+        self.assertEqual(set(ImportStateModel.objects.values_list('source', flat=True)), {'test', tasks.MERGED_SOURCE})
+
+    def test_new_product_gets_quantity(self):
+        with tempfile.NamedTemporaryFile() as f_obj:
+            tasks.merge_sources(self.results, '', f_obj.name)
+            AlboProductModel.objects.create(uniq_code='A000')
+            import_catalog(io.BytesIO(b'uniq_code\nA000\nA001\n'), 'catalog.csv')
+            AlboProductModel.objects.bulk_create([AlboProductModel(uniq_code='A002')])
+            # the next file changes another code only
+            results = [{**self.results[0], 'data': {'A000': 5, 'A002': 3},
+                        'marker': {**self.results[0]['marker'], 'filename': 'stock_2024-01-02T00:00:00.csv'}}]
+            tasks.merge_sources(results, '', f_obj.name)
+        self.assertEqual(list(AlboProductModel.objects.values_list('uniq_code', 'quantity').order_by('pk')),
+                         [('A000', 5), ('A000', 5), ('A001', 0), ('A002', 3)])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ACTIVITY_FLUSH_SIZE=1)
+class CustomerPriceTest(TestCase):
+    """The discounted price is shown to two places and its filter accepts only its own ranges."""
+
+    @classmethod
+    def setUpTestData(cls):
+        AlboProductModel.objects.create(uniq_code='A000', price_sample=51)
+        cls.user = MyUser.objects.create_superuser(email='price@example.com', password='password')
+        cls.user.resolution_value = 'is_admin_customer'
+        cls.user.discount = 30
+        cls.user.save()
+
+    def setUp(self):
+        cache.clear()
+        response = self.client.post('/customer-admin/login/', {'username': self.user.email, 'password': 'password'},
+                                    HTTP_USER_AGENT='test')
+        self.assertEqual(response.status_code, 302)
+        self.url = '/customer-admin/user_app/alboproductmodel/'
+
+    def test_price_is_rounded(self):
+        self.assertContains(self.client.get(self.url), '<td class="field-price_uniq">35.70</td>', html=True)
+        row = next(iter_price_list_rows(self.user.discount, None))
+        self.assertEqual(str(row[-1]), '35.70')
+
+    def test_price_filter(self):
+        self.assertContains(self.client.get(self.url, {'price_customer': '0-100'}), 'field-price_uniq')
+        self.assertNotContains(self.client.get(self.url, {'price_customer': '100-500'}), 'field-price_uniq')
+        for value in ('abc', '5-x', '0-50'):
+            with self.subTest(value=value):
+                response = self.client.get(self.url, {'price_customer': value})
+                self.assertRedirects(response, f'{self.url}?e=1', fetch_redirect_response=False)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ImportLockTest(TestCase):
+    """One import runs at a time, the triggers arriving during it fold into one run after it."""
+
+    def setUp(self):
+        cache.clear()
+        self.arguments = {'import_ftp_address': 'host:user:password', 'filename_for_export': 'export.txt'}
+
+    def get_runs(self, result):
+        return REGISTRY.get_sample_value('albo_import_runs_total', {'result': result}) or 0
+
+    def test_triggers_during_a_run_fold(self):
+        token = tasks.import_lock.acquire()
+        coalesced, skipped = self.get_runs('coalesced'), self.get_runs('skipped')
+        self.assertEqual(tasks.task_export(**self.arguments), {'status': 'coalesced'})
+        self.assertEqual(tasks.task_export(**{**self.arguments, '_type': 'txt'}), {'status': 'skipped'})
+        self.assertEqual(self.get_runs('coalesced'), coalesced + 1)
+        self.assertEqual(self.get_runs('skipped'), skipped + 1)
+
+        with mock.patch.object(tasks.task_export, 'apply_async') as apply_async:
+            tasks.release_import_lock(token)
+            tasks.release_import_lock(token)
+        # one run with the arguments of the latest trigger
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args.kwargs['kwargs']['_type'], 'txt')
+        self.assertFalse(tasks.import_lock.is_held(token))
+        self.assertIsNotNone(tasks.import_lock.acquire())
+
+    def test_failed_source_releases_lock(self):
+        with mock.patch.object(tasks, 'chord') as chord:
+            result = tasks.task_export(**self.arguments)
+        self.assertEqual(result['status'], 'started')
+        callback = chord.return_value.call_args.args[0]
+        token = callback.kwargs['lock_token']
+        self.assertTrue(tasks.import_lock.is_held(token))
+        self.assertEqual(tasks.task_export(**self.arguments), {'status': 'coalesced'})
+
+        # the chord calls the errback of its callback when a source task fails
+        errback = app.signature(callback.options['link_error'][0])
+        self.assertEqual(errback.task, tasks.task_release_import_lock.name)
+        with mock.patch.object(tasks.task_export, 'apply_async') as apply_async:
+            errback.apply(args=(None, ftplib.error_perm('550'), None))
+        self.assertFalse(tasks.import_lock.is_held(token))
+        apply_async.assert_called_once()
+
+    def test_failed_eager_run_releases_lock(self):
+        self.addCleanup(setattr, app.conf, 'task_always_eager', app.conf.task_always_eager)
+        app.conf.task_always_eager = True
+        with mock.patch.object(tasks.ftp_pool, 'connection', side_effect=ftplib.error_perm('550')), \
+                self.assertRaises(ftplib.error_perm):
+            tasks.task_export(**self.arguments)
+        self.assertIsNone(cache.get(tasks.import_lock.key))
+
+    def test_heartbeat_extends_lease(self):
+        lock = CacheLock('test', lease=0.3)
+        token = lock.acquire()
+        self.assertIsNone(lock.acquire())
+        with lock.heartbeat(token):
+            time.sleep(0.6)
+        self.assertTrue(lock.is_held(token))
+        time.sleep(0.4)
+        self.assertFalse(lock.is_held(token))
+        self.assertFalse(lock.extend(token))
+
+    def test_expired_lease_is_not_taken_over(self):
+        lock = CacheLock('test', lease=0.2, pending_timeout=0.2)
+        token = lock.acquire()
+        time.sleep(0.3)
+        other = lock.acquire()
+        self.assertIsNotNone(other)
+        self.assertFalse(lock.extend(token))
+        lock.release(token)
+        self.assertTrue(lock.is_held(other))
+
+        lock.request_pending({'_type': 'csv'})
+        time.sleep(0.3)
+        self.assertIsNone(lock.release(other))
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ACTIVITY_FLUSH_SIZE=1)
+class CatalogImportTest(TestCase):
+    """Catalog import of products, categories and 1C codes, and the report of the rows it refuses."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = CategoryProduct.objects.create(name_category='old')
+        AlboProductModel.objects.create(uniq_code='A1', describe='old', price_sample=1, category_product=cls.category)
+
+    def setUp(self):
+        cache.clear()
+
+    def import_csv(self, text, encoding='utf-8', **kwargs):
+        return import_catalog(io.BytesIO(text.encode(encoding)), 'catalog.csv', **kwargs)
+
+    def test_create_and_update(self):
+        report = self.import_csv('uniq_code;describe;price_sample;category;codes_1c\n'
+                                 'A1;Товар 1;1 234,5;old;001\n'
+                                 'A2;Товар 2;10;new;002, 003\n')
+        self.assertEqual((report['rows'], report['created'], report['updated']), (2, 1, 1))
+        self.assertEqual((report['categories'], report['mappings'], report['errors']), (1, 6, []))
+
+        product = AlboProductModel.objects.get(uniq_code='A1')
+        self.assertEqual((product.describe, product.price_sample, product.category_product), ('Товар 1', 1234.5,
+                                                                                             self.category))
+        self.assertEqual(AlboProductModel.objects.get(uniq_code='A2').category_product.name_category, 'new')
+        self.assertEqual(set(OneCCodeAlboModel.objects.values_list('map_code__uniq_code', 'uniq_code_one_c')),
+                         {('A1', '001'), ('A2', '002'), ('A2', '003')})
+        self.assertEqual(set(OneCCodeModel.objects.values_list('map_code__uniq_code', 'uniq_code_one_c')),
+                         {('A1', '001'), ('A2', '002'), ('A2', '003')})
+        self.assertEqual(get_code_index(), {'001': ['A1'], '002': ['A2'], '003': ['A2']})
+
+        # a second import adds nothing and leaves the missing columns unchanged
+        report = self.import_csv('Код товара;codes_1c\nA2;002\n')
+        self.assertEqual((report['created'], report['updated'], report['mappings']), (0, 1, 0))
+        self.assertEqual(AlboProductModel.objects.get(uniq_code='A2').describe, 'Товар 2')
+
+    def test_xlsx(self):
+        from openpyxl import Workbook
+
+        workbook = Workbook()
+        workbook.active.append(['uniq_code', 'size_field'])
+        workbook.active.append(['A3', 7])
+        file = io.BytesIO()
+        workbook.save(file)
+        file.seek(0)
+        report = import_catalog(file, 'catalog.xlsx')
+        self.assertEqual((report['created'], report['errors']), (1, []))
+        self.assertEqual(AlboProductModel.objects.get(uniq_code='A3').size_field, 7)
+
+    def test_error_report(self):
+        report = self.import_csv('uniq_code;price_sample\n;1\nA2;abc\nA3;2\n')
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['errors'], [(2, 'uniq_code is empty'), (3, "price_sample is not a number: 'abc'")])
+        self.assertEqual(self.import_csv('describe\nA1\n')['errors'], [(1, 'no uniq_code column in the header')])
+
+    def test_unreadable_files(self):
+        report = self.import_csv('uniq_code;describe\nA4;Товар\n', encoding='cp1251')
+        self.assertEqual((report['created'], report['errors']), (1, []))
+        self.assertEqual(AlboProductModel.objects.get(uniq_code='A4').describe, 'Товар')
+
+        # rows before an undecodable one are written and the rest of the file is reported
+        data = 'uniq_code\n'.encode() + ''.join(f'B{i}\n' for i in range(20_000)).encode() + b'\xff\n'
+        report = import_catalog(io.BytesIO(data), 'catalog.csv', batch_size=1000)
+        self.assertEqual(report['created'], 20_000)
+        self.assertEqual(len(report['errors']), 1)
+        self.assertEqual(report['errors'][0][0], 20_002)
+
+        report = import_catalog(io.BytesIO(b'not a workbook'), 'catalog.xlsx')
+        self.assertEqual(len(report['errors']), 1)
+        self.assertTrue(report['errors'][0][1].startswith('not an XLSX file'))
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', encoding='utf-8') as f_obj:
+            f_obj.write('uniq_code;describe\nA5;Товар\n')
+            f_obj.flush()
+            stdout = io.StringIO()
+            call_command('import_catalog', f_obj.name, stdout=stdout)
+        self.assertIn('created: 1', stdout.getvalue())
+
+    def test_view_permission(self):
+        url = '/customer-admin/user_app/alboproductmodel/import/'
+        customer = MyUser.objects.create(email='customer@example.com', is_staff=True,
+                                         resolution_value='is_admin_customer')
+        customer.set_password('password')
+        customer.save()
+        admin = MyUser.objects.create_superuser(email='admin@example.com', password='password')
+        admin.resolution_value = 'is_admin_customer'
+        admin.save()
+
+        for user, status in ((customer, 403), (admin, 200)):
+            with self.subTest(user=user.email):
+                self.client = self.client_class()
+                response = self.client.post('/customer-admin/login/', {'username': user.email,
+                                                                       'password': 'password'},
+                                            HTTP_USER_AGENT='test')
+                self.assertEqual(response.status_code, 302)
+                self.assertEqual(self.client.get(url).status_code, status)
+                response = self.client.post(url, {'file': SimpleUploadedFile('catalog.csv', b'uniq_code\nA6\n'),
+                                                  'delimiter': ';'})
+                self.assertEqual(response.status_code, status)
+        self.assertEqual(AlboProductModel.objects.filter(uniq_code='A6').count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ACTIVITY_FLUSH_SIZE=1)
+class PriceListTest(TestCase):
+    """Price lists are built once per discount, visible categories and catalog version."""
+
+    @classmethod
+    def setUpTestData(cls):
+        shown, hidden = CategoryProduct.objects.bulk_create([CategoryProduct(name_category='shown'),
+                                                             CategoryProduct(name_category='hidden')])
+        AlboProductModel.objects.bulk_create([
+            AlboProductModel(uniq_code='A1', describe='shown', price_sample=51, category_product=shown),
+            AlboProductModel(uniq_code='A2', describe='hidden', price_sample=10, category_product=hidden),
+            AlboProductModel(uniq_code='A3', describe='no category', price_sample=6.8),
+        ])
+        ProductModel.objects.create(uniq_code='P1', describe='project', price_sample=100, category_product=shown)
+        cls.user = MyUser.objects.create_superuser(email='prices@example.com', password='password')
+        cls.user.resolution_value = 'is_admin_customer'
+        cls.user.discount = 30
+        cls.user.save()
+        CategoryProductExclude.objects.create(exclude_category=hidden, exclude_user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        price_list_root = override_settings(PRICE_LIST_ROOT=directory)
+        price_list_root.enable()
+        self.addCleanup(price_list_root.disable)
+        self.addCleanup(setattr, app.conf, 'task_always_eager', app.conf.task_always_eager)
+        app.conf.task_always_eager = True
+
+    def read_rows(self, path):
+        with open(path, encoding='utf-8') as f_obj:
+            return [line.split(';') for line in f_obj.read().splitlines()[1:]]
+
+    def test_built_once_per_catalog_version(self):
+        with mock.patch.object(tasks, 'build_price_list', wraps=build_price_list) as build:
+            self.assertIsNone(get_price_list(self.user, 'csv'))
+            path = get_price_list(self.user, 'csv')
+            self.assertEqual(get_price_list(self.user, 'csv'), path)
+            self.assertEqual(build.call_count, 1)
+
+            AlboProductModel.objects.filter(uniq_code='A1').update(price_sample=61)
+            invalidate_catalog()
+            self.assertIsNone(get_price_list(self.user, 'csv'))
+            self.assertEqual(get_price_list(self.user, 'csv'), path)
+            self.assertEqual(build.call_count, 2)
+        rows = self.read_rows(path)
+        self.assertIn(['Продукт Albo', 'shown', 'A1', 'shown', '61.0', '42.70'], rows)
+        # the category excluded for the customer is left out
+        self.assertEqual([row[2] for row in rows], ['A1', 'A3', 'P1'])
+
+    def test_rows(self):
+        path = build_price_list(self.user.discount, [CategoryProduct.objects.get(name_category='shown').pk], 'csv')
+        self.assertEqual(self.read_rows(path), [
+            ['Продукт Albo', 'shown', 'A1', 'shown', '51.0', '35.70'],
+            ['Продукт Albo', '', 'A3', 'no category', '6.8', '4.76'],
+            ['Продукт', 'shown', 'P1', 'project', '100.0', '70.00'],
+        ])
+
+    def test_view(self):
+        response = self.client.post('/customer-admin/login/', {'username': self.user.email, 'password': 'password'},
+                                    HTTP_USER_AGENT='test')
+        self.assertEqual(response.status_code, 302)
+        url = '/customer-admin/price-list/xlsx/'
+        with mock.patch.object(tasks.task_price_list, 'delay') as delay:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response['Refresh'], '15')
+            self.client.get(url)
+        delay.assert_called_once()
+
+        build_price_list(*delay.call_args.args)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('price_list.xlsx', response['Content-Disposition'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+        self.assertEqual(self.client.get('/customer-admin/price-list/pdf/').status_code, 404)
+
+
+@override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'], METRICS_TOKEN='secret')
+class MetricsViewTest(SimpleTestCase):
+    """/metrics/ answers the allowed addresses and the holders of the token only."""
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 200)
+        for headers, status in (({}, 403), ({'HTTP_AUTHORIZATION': 'Bearer wrong'}, 403),
+                                ({'HTTP_AUTHORIZATION': 'Bearer secret'}, 200)):
+            with self.subTest(headers=headers):
+                response = self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1', **headers)
+                self.assertEqual(response.status_code, status)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer ')
+                             .status_code, 403)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class KeysetPaginatorTest(TestCase):
+    """Pages sought from the cached start of the page are the pages of OFFSET."""
+
+    @classmethod
+    def setUpTestData(cls):
+        list_category = CategoryProduct.objects.bulk_create(
+            CategoryProduct(name_category=name) for name in ('b', 'a', 'c'))
+        # NULL categories and many ties of (category, size) that only pk tells apart
+        AlboProductModel.objects.bulk_create(
+            AlboProductModel(uniq_code=f'A{i:03d}', size_field=i % 3,
+                             category_product=list_category[i % 4] if i % 4 < 3 else None)
+            for i in range(100))
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, queryset, cached):
+        paginator = KeysetPaginator(queryset, 7)
+        result = []
+        for number in paginator.page_range:
+            if not cached:
+                cache.clear()
+            with CaptureQueriesContext(connection) as context:
+                result.extend(obj.pk for obj in paginator.page(number))
+            # the page query, the category of the key comes with it through select_related
+            self.assertEqual(len(context), 1)
+            sql = context.captured_queries[0]['sql']
+            self.assertEqual('OFFSET' in sql.upper(), number > 1 and not cached, sql)
+        return result
+
+    def test_orderings(self):
+        queryset = AlboProductModel.objects.select_related('category_product')
+        list_order_by = [
+            (F('category_product__name_category').asc(nulls_last=True), 'size_field', 'pk'),
+            (F('category_product__name_category').desc(nulls_first=True), '-size_field', '-pk'),
+            (F('category_product__name_category').asc(nulls_first=True), '-size_field', 'pk'),
+            (F('category_product__name_category').desc(nulls_last=True), 'size_field', '-pk'),
+        ]
+        for order_by in list_order_by:
+            with self.subTest(order_by=order_by):
+                queryset = queryset.order_by(*order_by)
+                expected = list(queryset.values_list('pk', flat=True))
+                self.assertEqual(len(expected), 100)
+                self.assertEqual(self.walk(queryset, cached=False), expected)
+                self.assertEqual(self.walk(queryset, cached=True), expected)
+
+    def test_unsupported_ordering(self):
+        # a nullable column without NULLS FIRST/LAST has no keyset, the pages use OFFSET
+        queryset = AlboProductModel.objects.order_by('category_product__name_category', 'pk')
+        self.assertIsNone(KeysetPaginator(queryset, 7).get_keyset())
+
+
+class EstimatedCountPaginatorTest(TestCase):
+    """Above the threshold the count comes from the PostgreSQL planner, below it from COUNT."""
+
+    @classmethod
+    def setUpTestData(cls):
+        AlboProductModel.objects.bulk_create(AlboProductModel(uniq_code=f'A{i}') for i in range(3))
+
+    def mock_postgresql(self, row):
+        connections = mock.MagicMock()
+        db = connections.__getitem__.return_value
+        db.vendor = 'postgresql'
+        db.ops.quote_name = connection.ops.quote_name
+        cursor = db.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = row
+        return mock.patch('user_app.paginator.connections', connections), cursor
+
+    def test_reltuples_of_unfiltered_table(self):
+        patch, cursor = self.mock_postgresql((250_000,))
+        with patch, self.assertNumQueries(0):
+            self.assertEqual(EstimatedCountPaginator(AlboProductModel.objects.all(), 100).count, 250_000)
+        self.assertIn('pg_class', cursor.execute.call_args.args[0])
+
+    def test_plan_rows_of_filtered_query(self):
+        patch, cursor = self.mock_postgresql(([{'Plan': {'Plan Rows': 150_000}}],))
+        with patch, self.assertNumQueries(0):
+            paginator = EstimatedCountPaginator(AlboProductModel.objects.filter(uniq_code__startswith='A'), 100)
+            self.assertEqual(paginator.count, 150_000)
+        self.assertTrue(cursor.execute.call_args.args[0].startswith('EXPLAIN (FORMAT JSON) SELECT'))
+
+    def test_exact_count_below_threshold(self):
+        patch, _ = self.mock_postgresql((50,))
+        with patch, self.assertNumQueries(1):
+            self.assertEqual(EstimatedCountPaginator(AlboProductModel.objects.all(), 100).count, 3)
+        # other backends always count
+        with self.assertNumQueries(1):
+            self.assertEqual(EstimatedCountPaginator(AlboProductModel.objects.all(), 100).count, 3)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachedDatesQuerySetTest(TestCase):
+    """The date_hierarchy buckets are read once per query and cache timeout."""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = MyUser.objects.create_superuser(email='dates@example.com', password='password')
+        UserActivityTrack.objects.bulk_create(
+            UserActivityTrack(user=user, session_key=str(i), ip='127.0.0.1', user_agent='test',
+                              login=timezone.make_aware(datetime(2024, i, 1)))
+            for i in range(1, 4))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cached_per_query(self):
+        queryset = CachedDatesQuerySet(UserActivityTrack)
+        with self.assertNumQueries(2):
+            first = (list(queryset.dates('login', 'month')), queryset.aggregate(Min('login')))
+        with self.assertNumQueries(0):
+            self.assertEqual((queryset.dates('login', 'month'), queryset.aggregate(Min('login'))), first)
+        self.assertEqual(len(first[0]), 3)
+
+        filtered = queryset.filter(session_key='1')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(filtered.dates('login', 'month')), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(queryset.dates('login', 'day')), 3)
+
+
+class LocalFTPServerMixin:
+    """A pyftpdlib server on a temporary directory, as the import benchmark runs against.
+
+    The server answers XMD5 with the MD5 of the file and records the offsets of REST and
+    the names of the uploads, complete or not.
+    """
+
+    def setUp(self):
+        super().setUp()
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler
+        from pyftpdlib.log import config_logging
+        from pyftpdlib.servers import FTPServer
+
+        config_logging(level=logging.WARNING)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.rest_offsets = []
+        self.uploads = []
+        rest_offsets, uploads = self.rest_offsets, self.uploads
+
+        class TestFTPHandler(FTPHandler):
+            authorizer = DummyAuthorizer()
+            proto_cmds = {**FTPHandler.proto_cmds,
+                          'XMD5': dict(perm='r', auth=True, arg=True, help='Syntax: XMD5 <SP> file-name.')}
+
+            def ftp_REST(self, line):
+                rest_offsets.append(int(line))
+                return super().ftp_REST(line)
+
+            def on_file_received(self, file):
+                uploads.append((os.path.basename(file), True))
+
+            def on_incomplete_file_received(self, file):
+                uploads.append((os.path.basename(file), False))
+
+            def ftp_XMD5(self, path):
+                with open(path, 'rb') as f_obj:
+                    self.respond('251 %s' % hashlib.md5(f_obj.read()).hexdigest())
+
+        TestFTPHandler.authorizer.add_user('test', 'test', self.directory, perm='elradfmw')
+        server = FTPServer(('127.0.0.1', 0), TestFTPHandler)
+        self.address = '127.0.0.1:test:test:%s' % server.socket.getsockname()[1]
+        threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+        self.addCleanup(server.close_all)
+        self.addCleanup(ftp_pool.clear)
+        ftp_pool.clear()
+
+
+@skipUnless(importlib.util.find_spec('pyftpdlib'), 'pyftpdlib is not installed')
+@override_settings(CACHES=LOCMEM_CACHES)
+class FTPDownloadTest(LocalFTPServerMixin, TestCase):
+    """A failed download is resumed by the retry of its task, a corrupt one is downloaded again."""
+
+    filename = 'stock_2024-01-01T00:00:00.csv'
+
+    @classmethod
+    def setUpTestData(cls):
+        list_uniq_code = UniqCodeModel.objects.bulk_create(UniqCodeModel(uniq_code=f'A{i}') for i in range(10))
+        OneCCodeModel.objects.bulk_create(
+            OneCCodeModel(map_code=list_uniq_code[i % 10], uniq_code_one_c=f'{i:09d}') for i in range(2000))
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(setattr, app.conf, 'task_always_eager', app.conf.task_always_eager)
+        app.conf.task_always_eager = True
+        download_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, download_dir)
+        settings_override = override_settings(IMPORT_DOWNLOAD_DIR=download_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.remote_path = os.path.join(self.directory, self.filename)
+        with open(self.remote_path, 'w', encoding='utf-8') as f_obj:
+            f_obj.write('Код;Количество\n')
+            f_obj.writelines(f'{i:09d};{i % 50}\n' for i in range(2000))
+        with open(self.remote_path, 'rb') as f_obj:
+            self.content = f_obj.read()
+        local_copy = os.path.join(download_dir, 'expected.csv')
+        shutil.copyfile(self.remote_path, local_copy)
+        self.expected = tasks.read_csv(local_copy)
+
+    def run_import(self, task_id='import'):
+        result = tasks.task_import_source.apply(args=(self.address,), kwargs={'streaming': False},
+                                                task_id=task_id).get()
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['marker']['size'], len(self.content))
+        self.assertEqual(result['data'], self.expected)
+        # the finished download is parsed and removed
+        self.assertEqual(os.listdir(settings.IMPORT_DOWNLOAD_DIR), [])
+
+    def test_interrupted_download_is_resumed(self):
+        received = []
+
+        def interrupted_write(write, direction='download'):
+            def wrapper(block):
+                write(block)
+                received.append(len(block))
+                if len(received) == 1:
+                    raise ConnectionResetError('transfer interrupted')
+            return wrapper
+
+        with mock.patch.object(tasks, 'counted_write', interrupted_write):
+            self.run_import()
+        self.assertEqual(self.rest_offsets, [received[0]])
+        self.assertEqual(sum(received), len(self.content))
+
+    def test_corrupt_partial_download_is_downloaded_again(self):
+        path = tasks.get_download_path('import', self.filename)
+        with open(path, 'wb') as f_obj:
+            f_obj.write(b'x' * 1000)
+        with self.assertRaises(tasks.DownloadVerifyError):
+            with ftp_pool.connection(self.address) as ftp:
+                tasks.get_file_ftp(ftp, self.filename, path, len(self.content))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.rest_offsets, [1000])
+
+        # the retry of the task starts from the beginning and succeeds
+        with open(path, 'wb') as f_obj:
+            f_obj.write(b'x' * 1000)
+        self.run_import()
+        self.assertEqual(self.rest_offsets, [1000, 1000])
+
+    def test_oversized_partial_download_is_downloaded_again(self):
+        with open(tasks.get_download_path('import', self.filename), 'wb') as f_obj:
+            f_obj.write(self.content + b'000000001;1\n')
+        self.run_import()
+        # nothing was left to fetch from the oversized file, the retry downloads all of it
+        self.assertEqual(self.rest_offsets, [])
+
+    def test_remote_md5(self):
+        with ftp_pool.connection(self.address) as ftp:
+            self.assertEqual(tasks.get_remote_md5(ftp, self.filename), hashlib.md5(self.content).hexdigest())
+            ftp.sendcmd = mock.Mock(side_effect=ftplib.error_perm('500 Command not understood.'))
+            self.assertIsNone(tasks.get_remote_md5(ftp, self.filename))
+
+    def test_old_downloads_are_pruned(self):
+        old = os.path.join(settings.IMPORT_DOWNLOAD_DIR, 'old-task-stock.csv')
+        recent = os.path.join(settings.IMPORT_DOWNLOAD_DIR, 'recent-task-stock.csv')
+        for path in (old, recent):
+            with open(path, 'wb') as f_obj:
+                f_obj.write(b'1')
+        expired = time.time() - settings.IMPORT_DOWNLOAD_MAX_AGE - 60
+        os.utime(old, (expired, expired))
+
+        path = tasks.get_download_path('task', f'/remote/{self.filename}')
+        self.assertEqual(path, os.path.join(settings.IMPORT_DOWNLOAD_DIR, f'task-{self.filename}'))
+        self.assertEqual(os.listdir(settings.IMPORT_DOWNLOAD_DIR), ['recent-task-stock.csv'])
+
+
+class FailingRows(dict):
+    """Rows whose reading fails after the first `rows`, as a dropped database connection would."""
+
+    def __init__(self, data, rows):
+        super().__init__(data)
+        self.rows = rows
+
+    def items(self):
+        for i, item in enumerate(super().items()):
+            if i == self.rows:
+                raise ConnectionResetError('rows interrupted')
+            yield item
+
+
+@skipUnless(importlib.util.find_spec('pyftpdlib'), 'pyftpdlib is not installed')
+class FTPExportTest(LocalFTPServerMixin, SimpleTestCase):
+    """The export is uploaded under a temporary name and renamed, a failed upload leaves no file."""
+
+    data = {f'A{i:07d}': i for i in range(20000)}
+
+    def get_rows(self):
+        return ''.join(f'{key};{value}\r\n' for key, value in self.data.items()).encode('utf-8')
+
+    def test_row_reader(self):
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                reader = RowReader(self.data, compress, chunk_rows=1000)
+                content = b''.join(iter(lambda: reader.read(8192), b''))
+                self.assertEqual(gzip.decompress(content) if compress else content, self.get_rows())
+                self.assertEqual(RowReader(self.data, compress).read(), content)
+
+    def test_export(self):
+        for compress, suffix in ((False, '.csv'), (True, '.csv.gz')):
+            with self.subTest(compress=compress):
+                dt_export = tasks.export_file_ftp(self.data, self.address, 'export_file.txt', compress=compress)
+                filename = f'export_{dt_export:%Y-%m-%dT%H:%M:%S}{suffix}'
+                temp_filename, complete = self.uploads.pop()
+                self.assertTrue(complete)
+                self.assertRegex(temp_filename, rf'^\.{re.escape(filename)}\.[0-9a-f]{{8}}\.part$')
+                self.assertEqual(os.listdir(self.directory), [filename])
+                with open(os.path.join(self.directory, filename), 'rb') as f_obj:
+                    content = f_obj.read()
+                self.assertEqual(gzip.decompress(content) if compress else content, self.get_rows())
+                os.remove(os.path.join(self.directory, filename))
+
+    def test_failed_upload_removes_temp_file(self):
+        with self.assertRaises(ConnectionResetError):
+            tasks.export_file_ftp(FailingRows(self.data, 10000), self.address, 'export_file.txt')
+        self.assertEqual(len(self.uploads), 1)
+        self.assertRegex(self.uploads[0][0], r'\.part$')
+        self.assertEqual(os.listdir(self.directory), [])